@@ -13,14 +13,18 @@ from mo_files import File
 from mo_future import first
 from mo_imports import export
 
-from mo_json import JxType, JX_TEXT
-from mo_streams._utils import Stream, Reader
+from mo_json import JxType, JX_TEXT, JX_INTEGER
+from mo_streams._parallel import pool_iter
+from mo_streams._utils import Stream, Reader, name_filter, close_iter
+from mo_streams.aggregates import Aggregate, Count, Sum, Min, Max, Mean, First, Reduce
 from mo_streams.byte_stream import ByteStream
 from mo_streams.empty_stream import EmptyStream
 from mo_streams.files import content, File_usingStream
 from mo_streams.function_factory import it
 from mo_streams.object_stream import ObjectStream, ERROR, WARNING, NONE
+from mo_streams.s3_utils import download_chunks, list_objects, get_bytes, get_client, PART_SIZE, WORKERS, PREFETCH
 from mo_streams.string_stream import StringStream
+from mo_streams.async_stream import AsyncObjectStream, AsyncByteStream, AsyncStringStream
 from mo_streams.type_utils import Typer, CallableTyper, StreamTyper, LazyTyper
 
 
@@ -45,34 +49,103 @@ def stream(value):
         example = first(value)
 
         def read_from_list():
-            for v in value:
-                yield v, {}
+            try:
+                for v in value:
+                    yield v, {}
+            finally:
+                close_iter(value)
 
         return ObjectStream(read_from_list(), Typer(example=example), JxType())
     elif is_many(value):
         example = first(value)
 
         def read():
-            yield example, {}
-            for v in value:
-                yield v, {}
+            try:
+                yield example, {}
+                for v in value:
+                    yield v, {}
+            finally:
+                # A GENERATOR FROM THE CALLER IS THE SOURCE OF THE CHAIN
+                close_iter(value)
 
         return ObjectStream(read(), Typer(example=example), JxType())
     else:
         return ObjectStream(iter([(value, {})]), Typer(example=value), JxType())
 
 
-def from_s3(bucket, key):
-    import boto3
-    return S3Object(boto3.resource('s3').Object(bucket, key))
+def from_s3(bucket, key, *, client=None):
+    return S3Object(bucket, key, client=client)
 
 
-class S3Object:
-    def __init__(self, obj):
-        self.obj = obj
+def from_s3_prefix(bucket, prefix="", *, filter=None, prefetch=PREFETCH, prefetch_size=PART_SIZE, client=None):
+    """
+    RETURN STREAM OF Files, ONE FOR EACH OBJECT UNDER prefix, WITH key, size AND etag ATTACHED
+    THE LISTING IS PAGED AS THE STREAM IS CONSUMED
+    :param filter: function of the key, or collection of keys, of the objects to return (applied before any fetch)
+    :param prefetch: number of objects downloaded ahead, on a thread pool, while the current one is processed
+    :param prefetch_size: objects larger than this are not prefetched, their content is downloaded when requested
+    :param client: boto3 s3 client (default is a shared, pooled, client)
+    """
+    client = client or get_client()
+    accept = name_filter(filter)
+
+    def fetch(obj):
+        if obj["Size"] <= prefetch_size:
+            return get_bytes(bucket, obj["Key"], obj["ETag"], client)
+        return None
+
+    def file(obj, data):
+        key = obj["Key"]
+        if data is None:
+            return File_usingStream(key, lambda: S3Object(bucket, key, client=client).content())
+        return File_usingStream(key, lambda: ByteStream(Reader(iter([data]))))
+
+    def read():
+        objects = (obj for obj in list_objects(bucket=bucket, prefix=prefix, client=client) if accept(obj["Key"]))
+        if prefetch:
+            futures = pool_iter(fetch, ((obj,) for obj in objects), workers=prefetch, max_pending=prefetch)
+            fetched = ((obj, future.result()) for (obj,), future in futures)
+        else:
+            fetched = ((obj, None) for obj in objects)
+        for obj, data in fetched:
+            yield file(obj, data), {"key": obj["Key"], "size": obj["Size"], "etag": obj["ETag"]}
 
-    def content(self) -> ByteStream:
-        return ByteStream(self.obj.get()['Body'])
+    return ObjectStream(read(), Typer(python_type=File_usingStream), JxType(key=JX_TEXT, size=JX_INTEGER, etag=JX_TEXT))
+
+
+class S3Object:
+    def __init__(self, bucket, key=None, *, client=None):
+        """
+        :param bucket: bucket name, or a boto3 s3.Object (the old S3Object(obj) form)
+        :param key: object key (not given with a boto3 s3.Object)
+        :param client: boto3 s3 client (default is a shared, pooled, client)
+        """
+        if key is None:
+            obj = bucket
+            self.obj = obj
+            bucket, key, client = obj.bucket_name, obj.key, client or obj.meta.client
+        self.bucket = bucket
+        self.key = key
+        self.client = client
+
+    def content(self, *, part_size=PART_SIZE, workers=WORKERS, prefetch=None) -> ByteStream:
+        """
+        :param part_size: bytes per ranged GET
+        :param workers: number of parts downloaded at once (None or 1 for one sequential GET)
+        :param prefetch: maximum number of parts held in memory (default 2*workers)
+        """
+        return ByteStream(
+            Reader(
+                download_chunks(
+                    bucket=self.bucket,
+                    key=self.key,
+                    part_size=part_size,
+                    workers=workers,
+                    prefetch=prefetch,
+                    client=self.client,
+                )
+            )
+        )
 
 
 STR_CALL = CallableTyper(return_type=str)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from math import log, ceil
+
+from mo_logs import logger
+
+MASK = 2 ** 64 - 1
+INITIAL_CAPACITY = 64 * 1024  # FIRST LAYER, WHEN THE NUMBER OF VALUES IS NOT KNOWN
+GROWTH = 4  # EACH NEW LAYER HOLDS THIS MANY TIMES MORE
+
+
+class BloomFilter:
+    """
+    A SET THAT CAN ONLY ADD, AND MAY CLAIM TO CONTAIN VALUES IT DOES NOT (AT error_rate)
+    MEMORY IS ABOUT 1.2 BYTES PER EXPECTED VALUE FOR error_rate=0.01
+    WITHOUT A capacity IT STARTS SMALL; WHEN FULL, A BIGGER LAYER IS ADDED, WITH HALF THE error_rate, SO
+    THE TOTAL STAYS UNDER error_rate
+    """
+
+    def __init__(self, capacity=None, error_rate=0.01):
+        """
+        :param capacity: expected number of distinct values; the error rate grows beyond this (None to grow instead)
+        :param error_rate: chance a new value is reported as already seen
+        """
+        if not 0 < error_rate < 1:
+            logger.error("expecting error_rate between 0 and 1, not {{error_rate}}", error_rate=error_rate)
+        self.grow = not capacity
+        if self.grow:
+            self.layers = [_Layer(INITIAL_CAPACITY, error_rate / 2)]
+        else:
+            self.layers = [_Layer(capacity, error_rate)]
+
+    def add(self, value):
+        """
+        ADD value, RETURN True IF IT WAS (PROBABLY) ALREADY SEEN
+        """
+        h1, h2 = _hashes(value)
+        layers = self.layers
+        for layer in layers[:-1]:
+            if layer.contains(h1, h2):
+                return True
+        last = layers[-1]
+        if last.add(h1, h2):
+            return True
+        if self.grow and last.count >= last.capacity:
+            layers.append(_Layer(last.capacity * GROWTH, last.error_rate / 2))
+        return False
+
+    def __contains__(self, value):
+        h1, h2 = _hashes(value)
+        return any(layer.contains(h1, h2) for layer in self.layers)
+
+
+class _Layer:
+    """
+    ONE BIT ARRAY, SIZED FOR capacity VALUES AT error_rate
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.num_hashes = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, h1, h2):
+        bits, size = self.bits, self.size
+        seen = True
+        for i in range(self.num_hashes):
+            index = (h1 + i * h2) % size
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                seen = False
+                bits[index >> 3] |= mask
+        if not seen:
+            self.count += 1
+        return seen
+
+    def contains(self, h1, h2):
+        bits, size = self.bits, self.size
+        for i in range(self.num_hashes):
+            index = (h1 + i * h2) % size
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+def _hashes(value):
+    # DOUBLE HASHING: h1 + i*h2, BOTH MIXED FROM THE PYTHON hash (WHICH IS NOT WELL DISTRIBUTED FOR int)
+    h1 = _mix(hash(value) & MASK)
+    return h1, _mix(h1) | 1
+
+
+def _mix(h):
+    # splitmix64 FINALIZER
+    h = (h + 0x9E3779B97F4A7C15) & MASK
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK
+    return h ^ (h >> 31)
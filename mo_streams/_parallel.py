@@ -0,0 +1,144 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from queue import Queue, Empty
+from threading import Thread, Event
+
+from mo_logs import logger
+
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+
+def new_pool(executor, workers):
+    pool_type = EXECUTORS.get(executor)
+    if not pool_type:
+        logger.error(
+            "expecting executor to be one of {{names}}, not {{executor|quote}}",
+            names=list(EXECUTORS),
+            executor=executor,
+        )
+    if pool_type is ProcessPoolExecutor:
+        # fork COPIES THE THREADS' LOCKS, AND THE WORKERS CAN HANG ON EXIT
+        return pool_type(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return pool_type(max_workers=workers)
+
+
+def pool_iter(func, args, *, workers, executor="thread", ordered=True, max_pending=None):
+    """
+    RUN func(*a) FOR EACH a IN args ON A POOL, WITH BOUNDED WORK IN FLIGHT
+    :param func: function to run (must be picklable for "process" executor)
+    :param args: iterator of argument tuples
+    :param workers: number of pool workers
+    :param executor: "thread" or "process"
+    :param ordered: True to return in the order of args, False to return as completed
+    :param max_pending: maximum number of submitted-but-not-returned calls (default 2*workers)
+    :return: generator of (a, future) pairs, the future is done
+    """
+    max_pending = max_pending or workers * 2
+    pool = new_pool(executor, workers)
+    pending = deque() if ordered else {}
+    try:
+        for a in args:
+            future = pool.submit(func, *a)
+            if ordered:
+                pending.append((a, future))
+                if len(pending) >= max_pending:
+                    a, future = pending.popleft()
+                    wait([future])
+                    yield a, future
+            else:
+                pending[future] = a
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future
+
+        if ordered:
+            while pending:
+                a, future = pending.popleft()
+                wait([future])
+                yield a, future
+        else:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future
+    finally:
+        for future in (pending if not ordered else (f for _, f in pending)):
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+_END = object()
+
+
+def prefetch_iter(iterator, size):
+    """
+    RETURN GENERATOR OVER iterator, WHICH IS ADVANCED BY A BACKGROUND THREAD, AT MOST size ITEMS AHEAD
+    EXCEPTIONS ARE RAISED IN THE CONSUMER; CLOSING THE GENERATOR STOPS THE THREAD, AND CLOSES iterator
+    """
+    queue = Queue(maxsize=max(1, size))
+    stopped = Event()
+
+    def fill():
+        try:
+            for item in iterator:
+                queue.put((item, None))
+                if stopped.is_set():
+                    return
+            queue.put((_END, None))
+        except BaseException as cause:
+            queue.put((_END, cause))
+        finally:
+            # A GENERATOR CAN ONLY BE CLOSED BY THE THREAD THAT RUNS IT
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    thread = None
+    try:
+        thread = Thread(target=fill, name="prefetch", daemon=True)
+        thread.start()
+        while True:
+            item, cause = queue.get()
+            if item is _END:
+                if cause is not None:
+                    raise cause
+                return
+            yield item
+    finally:
+        stopped.set()
+        while thread and thread.is_alive():
+            # UNBLOCK THE PRODUCER
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        thread and thread.join()
+
+
+_wrapped = {}
+
+
+def apply_function(func, value, attach):
+    """
+    RUN IN A WORKER PROCESS: CALL THE (PICKLED) func ON THE value/attachment PAIR
+    """
+    wrapper = _wrapped.get(func)
+    if wrapper is None:
+        from mo_streams.function_factory import wrap_func
+
+        wrapper, _ = wrap_func(func)
+        _wrapped[func] = wrapper
+    return wrapper(value, attach)
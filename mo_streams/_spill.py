@@ -0,0 +1,112 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import io
+import pickle
+from tempfile import TemporaryFile
+
+DEBUG = False
+
+SPILL_PARTITIONS = 16  # WHEN THE NUMBER OF SPILLED RECORDS IS NOT KNOWN YET
+MAX_PARTITIONS = 64  # OPEN FILES; A PARTITION THAT IS STILL TOO BIG IS PARTITIONED AGAIN
+MAX_DEPTH = 8  # WHEN EVEN THIS DOES NOT SPLIT A PARTITION, ITS KEYS HAVE THE SAME hash
+SPILL_LEVEL = 1  # FAST COMPRESSION, THE FILES ARE READ ONCE
+
+
+class SpillFile:
+    """
+    A TEMPORARY FILE OF PICKLED RECORDS, WRITTEN ONCE, THEN READ ONCE
+    COMPRESSED WITH zstandard, IF INSTALLED
+    """
+
+    def __init__(self):
+        self._file = TemporaryFile()
+        zstd = get_zstd()
+        if zstd:
+            self._writer = zstd.ZstdCompressor(level=SPILL_LEVEL).stream_writer(self._file, closefd=False)
+        else:
+            self._writer = self._file
+        self.count = 0
+
+    def write(self, record):
+        pickle.dump(record, self._writer, protocol=pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def extend(self, records):
+        for record in records:
+            self.write(record)
+
+    def read(self):
+        """
+        RETURN GENERATOR OF THE RECORDS, IN THE ORDER WRITTEN; THE FILE IS REMOVED WHEN DONE
+        """
+        if self._writer is not self._file:
+            self._writer.close()
+        self._file.seek(0)
+        zstd = get_zstd()
+        if zstd:
+            source = io.BufferedReader(zstd.ZstdDecompressor().stream_reader(self._file, closefd=False))
+        else:
+            source = self._file
+        try:
+            for _ in range(self.count):
+                yield pickle.load(source)
+        finally:
+            self.close()
+
+    def close(self):
+        self._file.close()
+
+
+class Partitions:
+    """
+    SPLIT RECORDS INTO SpillFiles BY HASH OF THEIR KEY
+    EQUAL KEYS ALWAYS LAND IN THE SAME PARTITION
+    """
+
+    def __init__(self, count=SPILL_PARTITIONS, depth=0):
+        """
+        :param depth: 0 for the first split, +1 for each split of a partition (so its keys are spread again)
+        """
+        self.files = [SpillFile() for _ in range(count)]
+        self.depth = depth
+
+    def write(self, key, record):
+        code = hash((self.depth, key)) if self.depth else hash(key)
+        self.files[code % len(self.files)].write(record)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def partition_count(size, memory_limit):
+    """
+    RETURN NUMBER OF PARTITIONS SO EACH OF size RECORDS HOLDS ABOUT memory_limit/2 (THE HASH IS NOT EVEN)
+    """
+    if size is None:
+        return SPILL_PARTITIONS
+    return max(2, min(MAX_PARTITIONS, -(-2 * size // memory_limit)))
+
+
+_zstd = None
+
+
+def get_zstd():
+    """
+    RETURN zstandard MODULE, OR False IF NOT INSTALLED
+    """
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+
+            _zstd = zstandard
+        except ImportError:
+            _zstd = False
+    return _zstd
@@ -7,7 +7,12 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 import inspect
-from io import RawIOBase, BytesIO
+import mmap
+import os
+from collections import deque
+from functools import wraps
+from io import RawIOBase
+from threading import Condition, RLock
 from typing import BinaryIO
 
 from mo_dots.lists import Log
@@ -16,10 +21,139 @@ from mo_logs import logger
 
 ByteStream = expect("ByteStream")
 START, CURRENT, END = 0, 1, 2
+MMAP_CHUNK_SIZE = 1024 * 1024
+LINE_CHUNK_SIZE = 1024 * 1024
 
 
 class Stream:
-    pass
+    """
+    BASE OF ALL STREAMS, A CONTEXT MANAGER THAT close()S ON EXIT
+    """
+
+    def close(self):
+        """
+        RELEASE THE RESOURCES (FILES, DECOMPRESSORS, CONNECTIONS) OF THIS STREAM AND EVERYTHING UPSTREAM
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def terminator(func):
+    """
+    DECORATE A METHOD THAT CONSUMES THE STREAM, SO THE CHAIN IS CLOSED WHEN IT RETURNS (OR RAISES)
+    """
+
+    @wraps(func)
+    def output(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.close()
+
+    return output
+
+
+def close_iter(iterator):
+    """
+    CLOSE THE GENERATOR, SO ITS finally CLAUSES RUN NOW, NOT WHEN IT IS GARBAGE COLLECTED
+    """
+    close = getattr(iterator, "close", None)
+    if close:
+        close()
+
+
+class ChunkBuffer:
+    """
+    A QUEUE OF bytes CHUNKS, WITH AN OFFSET INTO THE FIRST
+    EACH BYTE IS COPIED AT MOST ONCE ON THE WAY OUT
+    """
+
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, chunk):
+        if not chunk:
+            return
+        self._chunks.append(chunk)
+        self.size += len(chunk)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size:
+            size = self.size
+        if not size:
+            return b""
+        first = self._chunks[0]
+        offset = self._offset
+        end = offset + size
+        if end <= len(first):
+            if offset == 0 and end == len(first) and isinstance(first, bytes):
+                # WHOLE CHUNK, NO COPY
+                data = first
+            else:
+                data = bytes(memoryview(first)[offset:end])
+            self._advance(size)
+            return data
+
+        parts = []
+        remaining = size
+        while remaining:
+            first = self._chunks[0]
+            offset = self._offset
+            take = min(len(first) - offset, remaining)
+            parts.append(memoryview(first)[offset : offset + take])
+            self._advance(take)
+            remaining -= take
+        return b"".join(parts)
+
+    def readinto(self, b):
+        target = memoryview(b).cast("B")
+        size = min(len(target), self.size)
+        position = 0
+        while position < size:
+            first = self._chunks[0]
+            offset = self._offset
+            take = min(len(first) - offset, size - position)
+            target[position : position + take] = memoryview(first)[offset : offset + take]
+            self._advance(take)
+            position += take
+        return size
+
+    def skip(self, size):
+        size = min(size, self.size)
+        remaining = size
+        while remaining:
+            take = min(len(self._chunks[0]) - self._offset, remaining)
+            self._advance(take)
+            remaining -= take
+        return size
+
+    def drain(self):
+        """
+        REMOVE ALL CHUNKS, ONLY A PARTIALLY-READ FIRST CHUNK IS COPIED
+        """
+        while self._chunks:
+            first = self._chunks.popleft()
+            offset, self._offset = self._offset, 0
+            self.size -= len(first) - offset
+            yield bytes(memoryview(first)[offset:]) if offset else first
+
+    def _advance(self, size):
+        # ASSUME size FITS IN FIRST CHUNK
+        self._offset += size
+        self.size -= size
+        if self._offset == len(self._chunks[0]):
+            self._chunks.popleft()
+            self._offset = 0
 
 
 class Reader(BinaryIO):
@@ -29,45 +163,130 @@ class Reader(BinaryIO):
 
     def __init__(self, chunks):
         self._chunks = chunks
-        self.residue = b""
+        self._buffer = ChunkBuffer()
         self.count = 0
 
     def readable(self):
         return True
 
-    def read(self, size=-1):
-        if not self._chunks:
-            return self._more(size)
+    def seekable(self):
+        return False
 
+    def _fill(self, size):
+        """
+        PULL CHUNKS UNTIL size BYTES ARE BUFFERED, OR THE GENERATOR IS DONE
+        """
+        if self._chunks is None:
+            return
+        buffer = self._buffer
         try:
-            if size == -1:
-                data = next(self._chunks)
-                self.count += len(data)
-                return data
-
-            while len(self.residue) < size:
-                chunk = next(self._chunks)
-                self.residue += chunk
+            while buffer.size < size:
+                buffer.append(next(self._chunks))
         except StopIteration:
             self._chunks = None
-        return self._more(size)
 
-    def _more(self, size):
-        data = self.residue[:size]
-        self.residue = self.residue[size:]
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # WHATEVER IS BUFFERED, OR THE NEXT CHUNK
+            self._fill(1)
+            data = self._buffer.read()
+        else:
+            self._fill(size)
+            data = self._buffer.read(size)
         self.count += len(data)
         return data
 
+    def readinto(self, b):
+        self._fill(memoryview(b).nbytes)
+        size = self._buffer.readinto(b)
+        self.count += size
+        return size
+
+    def chunks(self):
+        """
+        RETURN THE REMAINING CONTENT AS A GENERATOR OF CHUNKS
+        """
+        for chunk in self._buffer.drain():
+            self.count += len(chunk)
+            yield chunk
+        if self._chunks is None:
+            return
+        for chunk in self._chunks:
+            self.count += len(chunk)
+            yield chunk
+        self._chunks = None
+
     def tell(self):
         return self.count
 
+    def close(self):
+        chunks, self._chunks = self._chunks, None
+        self._buffer = ChunkBuffer()
+        close_iter(chunks)
+
     def seek(self, position, whence=START):
-        if whence == END:
-            everything = BytesIO(b"".join(self._chunks))
+        if whence == CURRENT:
+            position += self.count
+        elif whence == END:
+            # MUST READ TO THE END TO KNOW WHERE IT IS
+            for _ in self.chunks():
+                pass
+            position += self.count
 
         if self.count > position:
             raise NotImplementedError()
-        self.read(position - self.count)
+        remaining = position - self.count
+        while remaining:
+            self._fill(1)
+            size = self._buffer.skip(remaining)
+            if not size:
+                break
+            self.count += size
+            remaining -= size
+        return self.count
+
+
+class SharedReader(RawIOBase):
+    """
+    A SEEKABLE reader SHARED BY THE LAZY MEMBERS OF AN ARCHIVE, AND THE (MAYBE OTHER) THREAD LISTING THEM
+    HOLD lock FOR EACH seek() AND read() PAIR, OR USE read_at()
+    reader IS CLOSED ON close(), OR WHEN THE LAST MEMBER IS RELEASED
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = RLock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.reader.seekable()
+
+    def tell(self):
+        return self.reader.tell()
+
+    def seek(self, offset, whence=START):
+        return self.reader.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def readinto(self, b):
+        return self.reader.readinto(b)
+
+    def read_at(self, offset, size):
+        with self.lock:
+            self.reader.seek(offset)
+            return self.reader.read(size)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.reader.close()
+        finally:
+            RawIOBase.close(self)
 
 
 class Writer(RawIOBase):
@@ -75,8 +294,13 @@ class Writer(RawIOBase):
     REPLACE IO SO THAT WE CAN read() THE RESULTING
     """
 
-    def __init__(self):
-        self._buffer = b""
+    def __init__(self, high_water=None):
+        """
+        :param high_water: when the buffer holds this many bytes, write() blocks until another thread reads it
+        """
+        self._buffer = ChunkBuffer()
+        self._high_water = high_water
+        self._lock = Condition()
 
     def writable(self):
         return True
@@ -87,24 +311,182 @@ class Writer(RawIOBase):
     def write(self, b):
         if self.closed:
             raise Exception("stream was closed")
-        self._buffer += b
-        return len(b)
+        # COPY ONLY IF THE CALLER CAN CHANGE IT
+        chunk = b if isinstance(b, bytes) else bytes(b)
+        with self._lock:
+            if self._high_water:
+                while self._buffer.size and self._buffer.size + len(chunk) > self._high_water and not self.closed:
+                    self._lock.wait()
+            self._buffer.append(chunk)
+        return len(chunk)
 
     def read(self, size=-1):
-        if size == -1 or size > len(self._buffer):
-            chunk = self._buffer
-            self._buffer = b""
-            return chunk
-
-        chunk = self._buffer[:size]
-        self._buffer = self._buffer[size:]
+        with self._lock:
+            chunk = self._buffer.read(-1 if size is None else size)
+            self._lock.notify_all()
         return chunk
 
+    def readinto(self, b):
+        with self._lock:
+            size = self._buffer.readinto(b)
+            self._lock.notify_all()
+        return size
+
+    def drain(self):
+        """
+        REMOVE AND RETURN ALL BUFFERED CHUNKS, WITHOUT JOINING THEM
+        """
+        with self._lock:
+            chunks = list(self._buffer.drain())
+            self._lock.notify_all()
+        return chunks
+
+    def close(self):
+        with self._lock:
+            RawIOBase.close(self)
+            self._lock.notify_all()
+
     def content(self):
         return ByteStream(self)
 
     def size(self):
-        return len(self._buffer)
+        return self._buffer.size
+
+
+class MmapReader(RawIOBase):
+    """
+    A SEEKABLE READER OVER A MEMORY-MAPPED LOCAL FILE
+    views() RETURNS ZERO-COPY memoryview SLICES OF THE MAPPING, chunks() RETURNS bytes
+    """
+
+    def __init__(self, path, chunk_size=MMAP_CHUNK_SIZE):
+        self._file = open(path, "rb")
+        try:
+            if os.fstat(self._file.fileno()).st_size:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+            else:
+                # EMPTY FILES CAN NOT BE MAPPED
+                self._map = None
+                self._view = memoryview(b"")
+        except Exception:
+            self._file.close()
+            raise
+        self._position = 0
+        self.chunk_size = chunk_size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=START):
+        if whence == START:
+            position = offset
+        elif whence == CURRENT:
+            position = self._position + offset
+        elif whence == END:
+            position = len(self._view) + offset
+        else:
+            logger.error("unknown whence {{whence}}", whence=whence)
+        if position < 0:
+            logger.error("can not seek to {{position}}", position=position)
+        self._position = position
+        return position
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        if end <= start:
+            return b""
+        self._position = end
+        return self._view[start:end].tobytes()
+
+    def readinto(self, b):
+        target = memoryview(b).cast("B")
+        start = self._position
+        end = min(start + len(target), len(self._view))
+        if end <= start:
+            return 0
+        target[: end - start] = self._view[start:end]
+        self._position = end
+        return end - start
+
+    def chunks(self, size=None):
+        """
+        RETURN GENERATOR OF bytes, FROM THE CURRENT POSITION TO THE END
+        """
+        for view in self.views(size):
+            yield view.tobytes()
+            view.release()
+
+    def views(self, size=None):
+        """
+        RETURN GENERATOR OF memoryview SLICES, FROM THE CURRENT POSITION TO THE END
+        EACH MUST BE USED BEFORE THE NEXT IS REQUESTED, A LIVE SLICE KEEPS THE MAPPING OPEN
+        """
+        size = size or self.chunk_size
+        view = self._view
+        while self._position < len(view):
+            start = self._position
+            self._position = min(start + size, len(view))
+            yield view[start : self._position]
+
+    def lines(self, encoding="utf8"):
+        """
+        RETURN GENERATOR OF LINES (WITHOUT THE \\n), FROM THE CURRENT POSITION
+        THE MAPPING IS SCANNED IN BLOCKS OF WHOLE LINES, EACH BLOCK IS DECODED AND SPLIT ONCE
+        THE LAST LINE IS INCLUDED ONLY IF NOT EMPTY
+        :param encoding: None TO RETURN bytes LINES
+        """
+        view, end = self._view, len(self._view)
+        separator = "\n" if encoding else b"\n"
+        start = self._position
+        while start < end:
+            stop = start + self.chunk_size
+            if stop >= end:
+                stop = end
+            else:
+                newline = self._map.rfind(b"\n", start, stop)
+                if newline == -1:
+                    # LINE LONGER THAN A BLOCK
+                    newline = self._map.find(b"\n", stop)
+                stop = end if newline == -1 else newline + 1
+            block = view[start:stop]
+            lines = (str(block, encoding) if encoding else block.tobytes()).split(separator)
+            block.release()
+            if not lines[-1]:
+                lines.pop()
+            self._position = start = stop
+            yield from lines
+
+    def close(self):
+        if self.closed:
+            return
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # SOME SLICES ARE STILL IN USE, THE MAPPING IS CLOSED WHEN THEY ARE RELEASED
+                pass
+        self._file.close()
+        RawIOBase.close(self)
+
+
+def open_file(path):
+    """
+    RETURN A READER FOR THE LOCAL FILE, MEMORY-MAPPED IF POSSIBLE
+    """
+    try:
+        return MmapReader(path)
+    except (OSError, ValueError):
+        # PIPES, DEVICES, AND OTHER FILES THAT CAN NOT BE MAPPED
+        return open(path, "rb")
 
 
 def chunk_bytes(reader, size=4096):
@@ -115,7 +497,11 @@ def chunk_bytes(reader, size=4096):
     if isinstance(reader, ByteStream):
         reader = reader.reader
     if isinstance(reader, Reader):
-        return reader._chunks
+        return _close_after(reader, reader.chunks())
+    if isinstance(reader, Writer):
+        return _drain(reader)
+    if isinstance(reader, MmapReader):
+        return _close_after(reader, reader.chunks())
 
     def read():
         """
@@ -138,6 +524,107 @@ def chunk_bytes(reader, size=4096):
     return read()
 
 
+def chunk_views(reader, size=4096):
+    """
+    LIKE chunk_bytes(), BUT NO CHUNK IS LARGER THAN size, AND CHUNKS MAY BE memoryview (OF A MAPPED FILE,
+    OR OF A LARGER CHUNK), FOR CONSUMERS (LIKE DECODERS, AND join) THAT ARE DONE WITH EACH CHUNK BEFORE
+    ASKING FOR THE NEXT
+    """
+    if isinstance(reader, ByteStream):
+        reader = reader.reader
+    if isinstance(reader, MmapReader):
+        return _close_after(reader, reader.views(size))
+    if isinstance(reader, Reader):
+        return _close_after(reader, _split_chunks(reader.chunks(), size))
+    return chunk_bytes(reader, size)
+
+
+def _split_chunks(chunks, size):
+    for chunk in chunks:
+        if len(chunk) <= size:
+            yield chunk
+            continue
+        view = memoryview(chunk)
+        for start in range(0, len(view), size):
+            yield view[start : start + size]
+
+
+def split_lines(chunks, newline="\n"):
+    """
+    RETURN GENERATOR OF LINES (WITHOUT newline) FROM A GENERATOR OF str (OR bytes) CHUNKS
+    EACH CHUNK IS SPLIT ONCE, ONLY THE PARTIAL LAST LINE IS CARRIED TO THE NEXT CHUNK
+    THE LAST LINE IS INCLUDED ONLY IF NOT EMPTY
+    """
+    empty = newline[:0]
+    tail = []
+    for chunk in chunks:
+        lines = chunk.split(newline)
+        if len(lines) == 1:
+            if chunk:
+                tail.append(chunk)
+            continue
+        if tail:
+            tail.append(lines[0])
+            lines[0] = empty.join(tail)
+            tail = []
+        last = lines.pop()
+        if last:
+            tail.append(last)
+        yield from lines
+    if tail:
+        yield empty.join(tail)
+
+
+def decode_lines(chunks, encoding="utf8"):
+    """
+    RETURN GENERATOR OF str LINES FROM A GENERATOR OF bytes CHUNKS
+    THE COMPLETE LINES OF EACH CHUNK ARE DECODED AND SPLIT WITH ONE CALL EACH
+    encoding MUST BE ASCII-COMPATIBLE (b"\\n" IS NEVER PART OF A MULTIBYTE CHARACTER)
+    """
+    tail = []
+    for chunk in chunks:
+        end = chunk.rfind(b"\n")
+        if end == -1:
+            if chunk:
+                tail.append(chunk)
+            continue
+        block = memoryview(chunk)[:end]
+        if tail:
+            tail.append(block)
+            block = b"".join(tail)
+        yield from str(block, encoding).split("\n")
+        tail = [memoryview(chunk)[end + 1 :]] if end + 1 < len(chunk) else []
+    if tail:
+        yield str(b"".join(tail), encoding)
+
+
+def _drain(writer):
+    try:
+        yield from writer.drain()
+    finally:
+        writer.close()
+
+
+def _close_after(reader, chunks):
+    try:
+        yield from chunks
+    finally:
+        reader.close()
+
+
+def name_filter(filter):
+    """
+    RETURN FUNCTION OF MEMBER NAME
+    :param filter: function of the member name, or collection of member names
+    """
+    if filter is None:
+        return lambda name: True
+    if callable(filter):
+        return filter
+    names = set(filter)
+    return names.__contains__
+
+
 def is_function(value):
     if type(value).__name__ == "function":
         return True
@@ -0,0 +1,156 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from mo_dots import is_missing
+
+
+class _Nothing:
+    """
+    STATE BEFORE ANY VALUE IS SEEN
+    """
+
+    def __reduce__(self):
+        # UNPICKLES TO THE SAME OBJECT, SO SPILLED STATES CAN BE COMPARED WITH is
+        return "NOTHING"
+
+
+NOTHING = _Nothing()
+
+
+class Aggregate:
+    """
+    A STREAMING AGGREGATE: EACH GROUP KEEPS ONE SMALL STATE
+    SUBCLASSES DEFINE add(state, value), WHICH FOLDS ONE VALUE INTO THE STATE
+    merge() COMBINES TWO PARTIAL STATES (EARLIER FIRST)
+    MISSING VALUES ARE IGNORED
+    """
+
+    def __init__(self, value=None):
+        """
+        :param value: function, or FunctionFactory, to get the value to aggregate (default is the member)
+        """
+        self.value = value
+
+    def start(self):
+        return NOTHING
+
+    def merge(self, state, other):
+        if other is NOTHING:
+            return state
+        if state is NOTHING:
+            return other
+        return self.add(state, other)
+
+    def result(self, state):
+        return None if state is NOTHING else state
+
+
+class Count(Aggregate):
+    """
+    NUMBER OF MEMBERS, OR NUMBER OF EXISTING VALUES IF value IS GIVEN
+    """
+
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        if self.value is None or not is_missing(value):
+            return state + 1
+        return state
+
+    def merge(self, state, other):
+        return state + other
+
+    def result(self, state):
+        return state
+
+
+class Sum(Aggregate):
+    def add(self, state, value):
+        if is_missing(value):
+            return state
+        if state is NOTHING:
+            return value
+        return state + value
+
+
+class Min(Aggregate):
+    def add(self, state, value):
+        if is_missing(value):
+            return state
+        if state is NOTHING or value < state:
+            return value
+        return state
+
+
+class Max(Aggregate):
+    def add(self, state, value):
+        if is_missing(value):
+            return state
+        if state is NOTHING or value > state:
+            return value
+        return state
+
+
+class Mean(Aggregate):
+    def start(self):
+        return 0, 0
+
+    def add(self, state, value):
+        if is_missing(value):
+            return state
+        total, count = state
+        return total + value, count + 1
+
+    def merge(self, state, other):
+        return state[0] + other[0], state[1] + other[1]
+
+    def result(self, state):
+        total, count = state
+        return total / count if count else None
+
+
+class First(Aggregate):
+    """
+    FIRST VALUE SEEN, EVEN IF MISSING
+    """
+
+    def add(self, state, value):
+        return value if state is NOTHING else state
+
+    def merge(self, state, other):
+        return other if state is NOTHING else state
+
+
+class Reduce(Aggregate):
+    """
+    CUSTOM AGGREGATE: reducer(state, value) FOLDS EACH VALUE INTO THE STATE
+    reducer IS ALSO USED TO COMBINE PARTIAL STATES, SO IT MUST BE ASSOCIATIVE, AND start MUST BE ITS IDENTITY
+    """
+
+    def __init__(self, reducer, value=None, start=NOTHING):
+        Aggregate.__init__(self, value)
+        self.reducer = reducer
+        self.initial = start
+
+    def start(self):
+        return self.initial
+
+    def add(self, state, value):
+        if is_missing(value):
+            return state
+        if state is NOTHING:
+            return value
+        return self.reducer(state, value)
+
+    def merge(self, state, other):
+        if other is NOTHING:
+            return state
+        if state is NOTHING:
+            return other
+        return self.reducer(state, other)
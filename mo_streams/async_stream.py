@@ -0,0 +1,412 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+# asyncio COUNTERPARTS OF ObjectStream, ByteStream AND StringStream
+# CPU-HEAVY STEPS (DECOMPRESSION) AND THE SYNC STREAMS ARE RUN IN THREADS, SO THE EVENT LOOP IS NOT BLOCKED
+#
+import asyncio
+import codecs
+import inspect
+from collections import deque
+from functools import partial
+from itertools import islice
+from threading import Thread
+
+from mo_imports import export
+from mo_logs import logger
+
+from mo_json import JxType
+from mo_streams._utils import Reader
+from mo_streams.byte_stream import ByteStream
+from mo_streams.function_factory import normalize, compiled
+from mo_streams.object_stream import ObjectStream
+from mo_streams.string_stream import StringStream
+from mo_streams.type_utils import Typer, LazyTyper
+from mo_streams.zst_utils import new_decompressor
+
+DEBUG = False
+OFFLOAD_BATCH = 100  # MEMBERS PULLED FROM A SYNC STREAM PER THREAD HOP
+_DONE = object()
+
+
+class AsyncStream:
+    """
+    BASE OF THE ASYNC STREAMS, AN ASYNC CONTEXT MANAGER THAT aclose()S ON EXIT
+    """
+
+    _iter = None
+
+    async def aclose(self):
+        """
+        RELEASE THE RESOURCES OF THIS STREAM AND EVERYTHING UPSTREAM
+        """
+        await _aclose(self._iter)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+class AsyncObjectStream(AsyncStream):
+    """
+    A STREAM OF (value, attachments) PAIRS FROM AN ASYNC ITERATOR; async for RETURNS THE VALUES
+    """
+
+    def __init__(self, values, datatype=None, schema=None):
+        self._iter = values
+        self.typer = datatype or Typer()
+        self._schema = schema or JxType()
+
+    def __aiter__(self):
+        async def read():
+            try:
+                async for value, _ in self._iter:
+                    yield value
+            finally:
+                await self.aclose()
+
+        return read()
+
+    def map(self, accessor, *, concurrency=None):
+        """
+        :param accessor: function, coroutine function, or FunctionFactory, to apply to each member
+        :param concurrency: maximum number of calls awaited at once (results are still in order)
+        """
+        if inspect.iscoroutinefunction(accessor):
+            func, type_ = (lambda v, a: accessor(v)), LazyTyper()
+        else:
+            fact = normalize(accessor, domain_type=self.typer)
+            func, type_, _ = compiled(fact.build(self.typer, self._schema))
+
+        async def call(value, attach):
+            try:
+                result = func(value, attach)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            except Exception as cause:
+                DEBUG and logger.warning("problem operating on {{value}}", value=value, cause=cause)
+                return None
+
+        if not concurrency or concurrency <= 1:
+
+            async def read():
+                try:
+                    async for value, attach in self._iter:
+                        yield await call(value, attach), attach
+                finally:
+                    await self.aclose()
+
+            return AsyncObjectStream(read(), type_, self._schema)
+
+        async def read_concurrent():
+            pending = deque()
+            try:
+                async for value, attach in self._iter:
+                    pending.append((asyncio.ensure_future(call(value, attach)), attach))
+                    if len(pending) >= concurrency:
+                        task, a = pending.popleft()
+                        yield await task, a
+                while pending:
+                    task, a = pending.popleft()
+                    yield await task, a
+            finally:
+                for task, _ in pending:
+                    task.cancel()
+                await self.aclose()
+
+        return AsyncObjectStream(read_concurrent(), type_, self._schema)
+
+    def filter(self, predicate):
+        """
+        :param predicate: function, coroutine function, or FunctionFactory, returning True for the members to keep
+        """
+        if inspect.iscoroutinefunction(predicate):
+            func = lambda v, a: predicate(v)
+        else:
+            fact = normalize(predicate, domain_type=self.typer)
+            func, _, _ = compiled(fact.build(self.typer, self._schema))
+
+        async def call(value, attach):
+            try:
+                result = func(value, attach)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            except Exception as cause:
+                DEBUG and logger.warning("problem operating on {{value}}", value=value, cause=cause)
+                return False
+
+        async def read():
+            try:
+                async for value, attach in self._iter:
+                    if await call(value, attach):
+                        yield value, attach
+            finally:
+                await self.aclose()
+
+        return AsyncObjectStream(read(), self.typer, self._schema)
+
+    def limit(self, count):
+        async def read():
+            if count <= 0:
+                return
+            n = 0
+            try:
+                async for value, attach in self._iter:
+                    yield value, attach
+                    n += 1
+                    if n >= count:
+                        return
+            finally:
+                await self.aclose()
+
+        return AsyncObjectStream(read(), self.typer, self._schema)
+
+    async def to_list(self):
+        try:
+            return [value async for value, _ in self._iter]
+        finally:
+            await self.aclose()
+
+    async def first(self):
+        try:
+            async for value, _ in self._iter:
+                return value
+            return None
+        finally:
+            await self.aclose()
+
+    def to_sync(self) -> ObjectStream:
+        """
+        RETURN ObjectStream, THE ASYNC ITERATOR IS RUN ON A PRIVATE EVENT LOOP, IN ITS OWN THREAD
+        """
+        return ObjectStream(_to_sync(self._iter), self.typer, self._schema)
+
+
+class AsyncByteStream(AsyncStream):
+    """
+    A STREAM OF bytes FROM AN ASYNC ITERATOR OF CHUNKS
+    """
+
+    def __init__(self, chunks):
+        self._iter = chunks
+
+    def __aiter__(self):
+        return self._iter.__aiter__()
+
+    def from_zst(self, *, dictionary=None, max_window_size=0):
+        """
+        DECOMPRESS ALL THE FRAMES IN THE zst STREAM, IN A THREAD
+        """
+        decompressor = new_decompressor(dictionary=dictionary, max_window_size=max_window_size)
+
+        def decompress(state, data):
+            # state IS [decompressobj]; A NEW ONE IS NEEDED FOR EACH FRAME
+            output = []
+            while data:
+                obj = state[0]
+                output.append(obj.decompress(data))
+                if not obj.eof:
+                    break
+                data = obj.unused_data
+                state[0] = decompressor.decompressobj()
+            return b"".join(output)
+
+        async def read():
+            state = [decompressor.decompressobj()]
+            try:
+                async for chunk in self._iter:
+                    data = await _in_thread(partial(decompress, state, chunk))
+                    if data:
+                        yield data
+            finally:
+                await self.aclose()
+
+        return AsyncByteStream(read())
+
+    def decode(self, encoding="utf8", *, errors="strict"):
+        decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+
+        async def read():
+            try:
+                async for chunk in self._iter:
+                    text = decoder.decode(chunk)
+                    if text:
+                        yield text
+                text = decoder.decode(b"", final=True)
+                if text:
+                    yield text
+            finally:
+                await self.aclose()
+
+        return AsyncStringStream(read())
+
+    def utf8(self):
+        return self.decode("utf8")
+
+    def lines(self, encoding="utf8"):
+        """
+        RETURN STREAM OF LINES (WITHOUT THE \\n)
+        :param encoding: encoding of the bytes, None TO RETURN bytes LINES
+        """
+        if encoding:
+            return self.decode(encoding).lines()
+
+        return AsyncObjectStream(_split_lines(self._iter, b"\n"), Typer(python_type=bytes), JxType())
+
+    async def to_bytes(self):
+        try:
+            return b"".join([chunk async for chunk in self._iter])
+        finally:
+            await self.aclose()
+
+    def to_sync(self) -> ByteStream:
+        """
+        RETURN ByteStream, THE ASYNC ITERATOR IS RUN ON A PRIVATE EVENT LOOP, IN ITS OWN THREAD
+        """
+        return ByteStream(Reader(_to_sync(self._iter)))
+
+
+class AsyncStringStream(AsyncStream):
+    """
+    A STREAM OF str FROM AN ASYNC ITERATOR OF CHUNKS
+    """
+
+    def __init__(self, chunks):
+        self._iter = chunks
+
+    def __aiter__(self):
+        return self._iter.__aiter__()
+
+    def utf8(self):
+        async def read():
+            try:
+                async for chunk in self._iter:
+                    yield chunk.encode("utf8")
+            finally:
+                await self.aclose()
+
+        return AsyncByteStream(read())
+
+    def lines(self):
+        return AsyncObjectStream(_split_lines(self._iter, "\n"), Typer(python_type=str), JxType())
+
+    async def to_str(self):
+        try:
+            return "".join([chunk async for chunk in self._iter])
+        finally:
+            await self.aclose()
+
+    def to_sync(self) -> StringStream:
+        """
+        RETURN StringStream, THE ASYNC ITERATOR IS RUN ON A PRIVATE EVENT LOOP, IN ITS OWN THREAD
+        """
+        return StringStream(_to_sync(self._iter))
+
+
+async def _split_lines(chunks, newline):
+    """
+    ASYNC VERSION OF _utils.split_lines, WITH THE attachments OF ObjectStream
+    """
+    empty = newline[:0]
+    tail = []
+    try:
+        async for chunk in chunks:
+            lines = chunk.split(newline)
+            if len(lines) == 1:
+                if chunk:
+                    tail.append(chunk)
+                continue
+            if tail:
+                tail.append(lines[0])
+                lines[0] = empty.join(tail)
+                tail = []
+            last = lines.pop()
+            if last:
+                tail.append(last)
+            for line in lines:
+                yield line, {}
+        if tail:
+            yield empty.join(tail), {}
+    finally:
+        await _aclose(chunks)
+
+
+async def offload(iterator, batch_size=OFFLOAD_BATCH):
+    """
+    RETURN ASYNC GENERATOR OVER THE SYNC iterator, WHICH IS ADVANCED IN A THREAD, batch_size AT A TIME
+    """
+    try:
+        while True:
+            batch = await _in_thread(partial(_take, iterator, batch_size))
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close:
+            close()
+
+
+async def _aclose(aiterator):
+    """
+    CLOSE THE ASYNC GENERATOR, SO ITS finally CLAUSES RUN NOW, NOT WHEN IT IS GARBAGE COLLECTED
+    """
+    aclose = getattr(aiterator, "aclose", None)
+    if aclose:
+        await aclose()
+
+
+def _in_thread(func):
+    # asyncio.to_thread() IS NOT IN PYTHON 3.8
+    return asyncio.get_event_loop().run_in_executor(None, func)
+
+
+def _take(iterator, size):
+    return list(islice(iterator, size))
+
+
+def _to_sync(aiterator):
+    """
+    RETURN GENERATOR OVER THE ASYNC aiterator, WHICH MUST NOT DEPEND ON ANOTHER EVENT LOOP
+    """
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=loop.run_forever, name="async stream", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = asyncio.run_coroutine_threadsafe(_anext(aiterator), loop).result()
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        try:
+            asyncio.run_coroutine_threadsafe(_aclose(aiterator), loop).result()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+async def _anext(aiterator):
+    try:
+        return await aiterator.__anext__()
+    except StopAsyncIteration:
+        return _DONE
+
+
+export("mo_streams.object_stream", AsyncObjectStream)
+export("mo_streams.object_stream", offload)
+export("mo_streams.byte_stream", AsyncByteStream)
+export("mo_streams.byte_stream", offload)
+export("mo_streams.string_stream", AsyncStringStream)
+export("mo_streams.string_stream", offload)
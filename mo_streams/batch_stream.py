@@ -0,0 +1,254 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from itertools import compress
+from typing import Any, Iterator, Dict, Tuple, List
+
+from mo_dots import list_to_data, exists
+from mo_imports import expect
+from mo_logs import logger
+
+from mo_json import JxType, JX_INTEGER
+from mo_streams._utils import Stream, close_iter, terminator
+from mo_streams.expressions import (
+    evaluate_batch,
+    calls_user_code,
+    rows,
+    vectorize,
+    evaluate_numpy,
+    to_list,
+    get_numpy,
+    INT_LIMIT,
+)
+from mo_streams.function_factory import normalize, expression_of, compiled
+from mo_streams.type_utils import Typer
+
+ObjectStream = expect("ObjectStream")
+
+DEBUG = False
+
+
+class BatchStream(Stream):
+    """
+    A STREAM OF OBJECTS, MOVED IN BATCHES
+    EACH BATCH IS A list OF MEMBERS, AND A dict OF ATTACHMENT COLUMNS (ONE list PER ATTACHMENT NAME)
+    """
+
+    def __init__(self, batches, datatype, schema):
+        self._batches: Iterator[Tuple[List[Any], Dict[str, List[Any]]]] = batches
+        self.typer: Typer = datatype
+        self._schema: JxType = schema
+
+    def __data__(self):
+        return [f"...batches({self.typer})..."]
+
+    def close(self):
+        close_iter(self._batches)
+
+    def map(self, accessor):
+        fact = normalize(accessor, domain_type=self.typer)
+        acc_func, acc_type, acc_schema = compiled(fact.build(self.typer, self._schema))
+        expr = expression_of(acc_func)
+        vector = vectorize(expr)
+
+        def read():
+            for values, columns in self._batches:
+                yield _evaluate(expr, vector, acc_func, values, columns, None), columns
+
+        return BatchStream(read(), acc_type, self._schema)
+
+    def filter(self, predicate):
+        fact = normalize(predicate)
+        f, t, s = compiled(fact.build(self.typer, self._schema))
+        expr = expression_of(f)
+        vector = vectorize(expr)
+
+        def read():
+            for values, columns in self._batches:
+                # NUMPY ONLY COMPUTES THE mask, THE MEMBERS ARE KEPT AS GIVEN
+                mask = _evaluate(expr, vector, f, values, columns, False)
+                batch = _compress(values, columns, mask)
+                if batch:
+                    yield batch
+
+        return BatchStream(read(), self.typer, self._schema)
+
+    def attach(self, **kwargs):
+        facts = {k: normalize(v) for k, v in kwargs.items()}
+        mapper = {k: compiled(f.build(self.typer, self._schema)) for k, f in facts.items()}
+        more_schema = JxType(**{k: f.return_type for k, f in mapper.items()})
+        exprs = {k: expression_of(m.function) for k, m in mapper.items()}
+        vectors = {k: vectorize(e) for k, e in exprs.items()}
+
+        def read():
+            for values, columns in self._batches:
+                more = {
+                    k: _evaluate(exprs[k], vectors[k], m.function, values, columns, None) for k, m in mapper.items()
+                }
+                yield values, {**columns, **more}
+
+        return BatchStream(read(), self.typer, self._schema | more_schema)
+
+    def exists(self):
+        def read():
+            for values, columns in self._batches:
+                batch = _compress(values, columns, [exists(v) for v in to_list(values)])
+                if batch:
+                    yield batch
+
+        return BatchStream(read(), self.typer, self._schema)
+
+    def enumerate(self):
+        def read():
+            start = 0
+            for values, columns in self._batches:
+                end = start + len(values)
+                yield values, {**columns, "index": list(range(start, end))}
+                start = end
+
+        return BatchStream(read(), self.typer, self._schema | JxType(index=JX_INTEGER))
+
+    def limit(self, count):
+        def read():
+            remaining = count
+            try:
+                if remaining <= 0:
+                    return
+                for values, columns in self._batches:
+                    if len(values) > remaining:
+                        values = values[:remaining]
+                        columns = {k: c[:remaining] for k, c in columns.items()}
+                    remaining -= len(values)
+                    yield values, columns
+                    if not remaining:
+                        return
+            finally:
+                # DO NOT LEAVE THE UPSTREAM OPEN UNTIL IT IS GARBAGE COLLECTED
+                close_iter(self._batches)
+
+        return BatchStream(read(), self.typer, self._schema)
+
+    def unbatch(self):
+        """
+        RETURN TO AN ObjectStream, ONE MEMBER AT A TIME
+        """
+
+        def read():
+            for values, columns in self._batches:
+                values, columns = _to_lists(values, columns)
+                yield from zip(values, rows(values, columns))
+
+        return ObjectStream(read(), self.typer, self._schema)
+
+    ###########################################################################
+    # TERMINATORS
+    ###########################################################################
+
+    @terminator
+    def to_list(self):
+        return [v.to_list() if isinstance(v, Stream) else v for values, _ in self._batches for v in to_list(values)]
+
+    @terminator
+    def to_data(self):
+        return list_to_data([v for values, _ in self._batches for v in to_list(values)])
+
+    @terminator
+    def count(self):
+        return sum(len(values) for values, _ in self._batches)
+
+    @terminator
+    def sum(self):
+        return sum(_sum(values) for values, _ in self._batches)
+
+    @terminator
+    def first(self):
+        for values, _ in self._batches:
+            if len(values):
+                return to_list(values[:1])[0]
+
+    @terminator
+    def last(self):
+        output = None
+        for values, _ in self._batches:
+            if len(values):
+                output = values[-1:]
+        return None if output is None else to_list(output)[0]
+
+    @terminator
+    def join(self, separator):
+        return separator.join(v for values, _ in self._batches for v in to_list(values))
+
+
+def _evaluate(expr, vector, func, values, columns, default):
+    """
+    EVALUATE OVER THE WHOLE BATCH, IF THAT FAILS, RUN func ON EACH MEMBER
+    AN expr THAT CALLS USER CODE IS ALWAYS RUN ON EACH MEMBER, SO NO MEMBER IS CALLED TWICE
+    :param vector: True IF expr CAN BE EVALUATED WITH NUMPY
+    """
+    if vector:
+        result = evaluate_numpy(expr, values, columns)
+        if result is not None:
+            return result
+
+    values, columns = _to_lists(values, columns)
+    if not calls_user_code(expr):
+        try:
+            return evaluate_batch(expr, values, columns)
+        except Exception as cause:
+            DEBUG and logger.warning("batch failed, run one at a time", cause=cause)
+
+    result = []
+    for v, a in zip(values, rows(values, columns)):
+        try:
+            result.append(func(v, a))
+        except Exception as cause:
+            DEBUG and logger.warning("problem operating on {{value}}", value=v, cause=cause)
+            result.append(default)
+    return result
+
+
+def _compress(values, columns, mask):
+    """
+    RETURN THE BATCH WITH ONLY THE MEMBERS SELECTED BY mask, OR None IF EMPTY
+    """
+    numpy = get_numpy()
+    if numpy:
+        if not isinstance(mask, numpy.ndarray):
+            mask = numpy.fromiter(map(bool, mask), dtype=bool, count=len(values))
+        count = int(mask.sum())
+    else:
+        mask = list(map(bool, mask))
+        count = sum(mask)
+    if not count:
+        return None
+    if count == len(values):
+        return values, columns
+    return _select(values, mask), {k: _select(c, mask) for k, c in columns.items()}
+
+
+def _select(values, mask):
+    if isinstance(values, list):
+        return list(compress(values, mask))
+    return values[mask]
+
+
+def _to_lists(values, columns):
+    if isinstance(values, list) and all(isinstance(c, list) for c in columns.values()):
+        return values, columns
+    return to_list(values), {k: to_list(c) for k, c in columns.items()}
+
+
+def _sum(values):
+    if isinstance(values, list):
+        return sum(values)
+    if values.dtype.kind == "f":
+        return float(values.sum())
+    if len(values) and max(abs(int(values.max())), abs(int(values.min()))) * len(values) < INT_LIMIT:
+        return int(values.sum())
+    return sum(values.tolist())
+
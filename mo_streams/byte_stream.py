@@ -6,72 +6,237 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+import codecs
+import os
 from io import BytesIO
+from itertools import islice, chain
+from tempfile import TemporaryFile
 
+from mo_dots import to_data
 from mo_files import File
 from mo_imports import expect, export
 from mo_logs import logger
 
 from mo_json import JxType, JX_TEXT
-from mo_streams._utils import chunk_bytes, Stream
+from mo_json.stream import parse
+from mo_streams._parallel import pool_iter, prefetch_iter
+from mo_streams._utils import (
+    Reader,
+    Writer,
+    chunk_bytes,
+    chunk_views,
+    Stream,
+    MmapReader,
+    SharedReader,
+    decode_lines,
+    split_lines,
+    name_filter,
+    terminator,
+    close_iter,
+    LINE_CHUNK_SIZE,
+    MMAP_CHUNK_SIZE,
+)
+from mo_streams.compression import sniff, get_gzip, get_lz4
+from mo_streams.s3_utils import upload, PART_SIZE, WORKERS
+from mo_streams.tar_utils import build_index, load_index, index_to_bytes, member_chunks, range_chunks
+from mo_streams.zst_utils import (
+    next_frame,
+    decompress_frame,
+    compress_frame,
+    new_compressor,
+    new_decompressor,
+    MAX_FRAME_SIZE,
+)
 
-ObjectStream, StringStream, File_usingStream, Typer = expect(
-    "ObjectStream", "StringStream", "File_usingStream", "Typer"
+ObjectStream, StringStream, File_usingStream, Typer, LiveJxTyper, infer_jx_type, AsyncByteStream, offload = expect(
+    "ObjectStream",
+    "StringStream",
+    "File_usingStream",
+    "Typer",
+    "LiveJxTyper",
+    "infer_jx_type",
+    "AsyncByteStream",
+    "offload",
 )
 
 
 DEBUG = False
+JSONL_BATCH_SIZE = 1000
+SAMPLE_SIZE = 100
+DECODE_CHUNK_SIZE = 64 * 1024  # FITS IN CACHE, SEE tests/benchmark_decode.py
 
 
 class ByteStream(Stream):
-    def __init__(self, reader):
+    def __init__(self, reader, *, upstream=None):
+        """
+        :param reader: file-like object
+        :param upstream: file-like, or stream, also closed on close() (for wrappers, like gzip, that do not close the
+                         file they wrap)
+        """
         self.verbose = DEBUG
         self.reader: BytesIO = reader
+        self.upstream = upstream
 
     def close(self):
-        self.reader.close()
+        try:
+            self.reader.close()
+        finally:
+            if self.upstream is not None:
+                self.upstream.close()
 
-    def from_zip(self) -> ObjectStream:
+    def from_zip(self, *, workers=None, prefetch=None) -> ObjectStream:
         """
         RETURN A STREAM OF Files
+        :param workers: number of threads to decompress members in parallel (each member is read into memory)
+        :param prefetch: maximum number of members decompressed ahead of the consumer (default 2*workers)
         """
         from zipfile import ZipFile
 
         def read():
             # ZIP HAS DIRACTORY AT END OF FILE, MUST READ WHOLE THING
-            reader = self.reader
             try:
-                if not reader.seekable():
-                    reader = BytesIO(b"".join(chunk_bytes(reader)))
-                with ZipFile(reader, mode="r") as archive:
-                    for info in archive.filelist:
+                reader = self.reader if self.reader.seekable() else _spill(self.reader)
+            except BaseException:
+                self.reader.close()
+                raise
+            shared = SharedReader(reader)
+            try:
+                archive = ZipFile(shared, mode="r")
+                names = [info.filename for info in archive.filelist]
+                if workers:
+                    members = ((archive, name) for name in names)
+                    for (_, name), future in pool_iter(_read_member, members, workers=workers, max_pending=prefetch):
+                        data = future.result()
+                        yield File_usingStream(name, lambda data=data: ByteStream(Reader(iter([data])))), {"name": name}
+                else:
+                    for name in names:
                         yield File_usingStream(
-                            info.filename, lambda: ByteStream(archive.open(info.filename, "r")),
-                        ), {"name": info.filename}
-            finally:
-                reader.close()
+                            name, lambda name=name: ByteStream(archive.open(name, "r")),
+                        ), {"name": name}
+            except Exception:
+                # A BROKEN ARCHIVE; OTHERWISE shared IS CLOSED WITH THE LAST LAZY MEMBER, EVEN IF THE
+                # LISTING STOPS EARLY (LIKE first()), SO THE MEMBERS ALREADY GIVEN CAN STILL BE READ
+                shared.close()
+                raise
 
         return ObjectStream(read(), Typer(python_type=File_usingStream), JxType(name=JX_TEXT))
 
-    def from_zst(self):
+    def from_zst(self, *, dictionary=None, max_window_size=0, read_size=None, workers=None):
+        """
+        DECOMPRESS ALL THE FRAMES IN THE zst STREAM
+        :param dictionary: bytes, or zstandard.ZstdCompressionDict, used to compress
+        :param max_window_size: largest window allowed (0 for the zstd default of 128MB)
+        :param read_size: bytes to read from the source at a time
+        :param workers: number of threads to decompress frames in parallel (only helps with multi-frame streams);
+                        up to 2*workers frames, and their content, are held in memory at once; a stream of one
+                        frame, and everything from the first frame over MAX_FRAME_SIZE, is streamed instead
+        """
+        params = {"dictionary": dictionary, "max_window_size": max_window_size}
+        read_args = {"read_size": read_size} if read_size else {}
+        if workers:
+            reader = self.reader
+
+            def read():
+                rest = []  # START OF A FRAME TOO LARGE TO HOLD IN MEMORY
+
+                def frames():
+                    while True:
+                        frame, complete = next_frame(reader, MAX_FRAME_SIZE)
+                        if not complete:
+                            rest.append(frame)
+                            return
+                        if not frame:
+                            return
+                        yield frame, params
+
+                try:
+                    head = list(islice(frames(), 2))
+                    if len(head) == 2:
+                        for _, future in pool_iter(decompress_frame, chain(head, frames()), workers=workers):
+                            yield future.result()
+                    else:
+                        rest[:0] = [frame for frame, _ in head]
+                    if rest:
+                        source = Reader(chain(rest, chunk_bytes(reader, read_size or DECODE_CHUNK_SIZE)))
+                        stream_reader = new_decompressor(**params).stream_reader(
+                            source, read_across_frames=True, **read_args
+                        )
+                        yield from chunk_bytes(stream_reader, DECODE_CHUNK_SIZE)
+                finally:
+                    reader.close()
+
+            return ByteStream(Reader(read()), upstream=self.upstream)
+
+        stream_reader = new_decompressor(**params).stream_reader(
+            self.reader, closefd=True, read_across_frames=True, **read_args
+        )
+        return ByteStream(stream_reader, upstream=self.upstream)
+
+    def from_gzip(self):
+        return ByteStream(get_gzip().open(self.reader, "rb"), upstream=self)
+
+    def from_bz2(self):
+        import bz2
+
+        return ByteStream(bz2.open(self.reader, "rb"), upstream=self)
+
+    def from_xz(self):
+        import lzma
+
+        return ByteStream(lzma.open(self.reader, "rb"), upstream=self)
+
+    def from_lz4(self):
+        return ByteStream(get_lz4().open(self.reader, "rb"), upstream=self)
+
+    def decompress(self):
+        """
+        DECOMPRESS BASED ON THE MAGIC BYTES AT THE START OF THE STREAM, OR RETURN AS-IS
+        """
+        method, reader = sniff(self.reader)
+        # reader MAY WRAP self.reader, SO self IS STILL CLOSED WITH IT
+        stream = ByteStream(reader, upstream=self)
+        if not method:
+            return stream
+        return getattr(stream, method)()
+
+    def to_gzip(self, level=None):
         """
-        :param stream:
-        :return:
+        :param level: compression level (default depends on backend: gzip=9, isal=2, zlib-ng=6)
         """
-        from zstandard import ZstdDecompressor
+        gzip = get_gzip()
+
+        def read():
+            writer = Writer()
+            with gzip.open(writer, "wb", **({} if level is None else {"compresslevel": level})) as target:
+                for chunk in chunk_bytes(self.reader):
+                    target.write(chunk)
+                    yield from writer.drain()
+            yield from writer.drain()
+            writer.close()
 
-        stream_reader = ZstdDecompressor().stream_reader(self.reader, closefd=True)
-        return ByteStream(stream_reader)
+        return ByteStream(Reader(read()))
 
-    def from_tar(self):
+    def from_tar(self, *, index=None, filter=None):
         """
         return a stream of files
+        :param index: the index (see to_tar_index()), or the File of the sidecar it was written to,
+                      to seek directly to members
+        :param filter: function of the member name, or collection of names, of the members to return
         """
+        if index is not None:
+            return self._from_indexed_tar(load_index(index), name_filter(filter))
         import tarfile
 
-        tf = tarfile.open(mode="r:", fileobj=self.reader)
+        accept = name_filter(filter)
+        shared = SharedReader(self.reader)
+        tf = tarfile.open(mode="r:", fileobj=shared)
 
         def file(info):
+            if info.isreg() and not info.issparse() and shared.seekable():
+                # SEEKS BEFORE EACH READ, SO THE LISTING CAN MOVE ON IN ANOTHER THREAD
+                return File_usingStream(
+                    info.name, lambda: ByteStream(Reader(range_chunks(shared, info.offset_data, info.size)))
+                )
             reader = tf.extractfile(info)
             if reader is None:
                 # directories
@@ -82,52 +247,309 @@ class ByteStream(Stream):
         def read():
             try:
                 while True:
-                    info = tf.next()
+                    with shared.lock:
+                        info = tf.next()
                     if not info:
                         return
-                    yield file(info), {"name": info.name}
-            finally:
-                self.reader.close()
+                    if accept(info.name):
+                        yield file(info), {"name": info.name}
+            except Exception:
+                # A BROKEN ARCHIVE; OTHERWISE shared IS CLOSED WITH THE LAST LAZY MEMBER, EVEN IF THE
+                # LISTING STOPS EARLY (LIKE first()), SO THE MEMBERS ALREADY GIVEN CAN STILL BE READ
+                shared.close()
+                raise
 
         return ObjectStream(read(), Typer(python_type=File_usingStream), JxType(name=JX_TEXT))
 
-    def to_zst(self):
-        from zstandard import ZstdCompressor
+    def _from_indexed_tar(self, index, accept):
+        if not self.reader.seekable():
+            logger.error("reading a tar with an index requires a seekable source, like a file")
+        shared = SharedReader(self.reader)
 
-        return ByteStream(ZstdCompressor().stream_reader(self.reader))
+        def file(member):
+            if not member["file"]:
+                return File_usingStream(member["name"], lambda: None)
+            return File_usingStream(member["name"], lambda: ByteStream(Reader(member_chunks(shared, index, member))))
 
-    def utf8(self):
         def read():
-            for data in chunk_bytes(self.reader):
-                yield data.decode("utf8")
+            try:
+                for member in index["members"]:
+                    if accept(member["name"]):
+                        yield file(member), {"name": member["name"]}
+            except Exception:
+                shared.close()
+                raise
+
+        return ObjectStream(read(), Typer(python_type=File_usingStream), JxType(name=JX_TEXT))
+
+    def to_tar_index(self):
+        """
+        READ THE WHOLE (PLAIN OR zst) TAR, RETURN ByteStream OF ITS JSON INDEX, FOR WRITING TO A SIDECAR FILE
+        """
+        try:
+            index = build_index(self.reader)
+        finally:
             self.reader.close()
+        return ByteStream(Reader(iter([index_to_bytes(index)])))
+
+    def to_zst(
+        self,
+        *,
+        level=3,
+        threads=0,
+        long_distance=False,
+        window_log=None,
+        dictionary=None,
+        read_size=None,
+        frame_size=None,
+    ):
+        """
+        COMPRESS WITH zstandard
+        :param level: compression level (1 to 22, negative for faster)
+        :param threads: number of threads to compress with (-1 for one per core)
+        :param long_distance: True to enable long distance matching (use with a large window_log)
+        :param window_log: log2 of the window size, above 27 requires max_window_size to decompress
+        :param dictionary: bytes, or zstandard.ZstdCompressionDict, to compress with
+        :param read_size: bytes to read from the source at a time
+        :param frame_size: bytes of input per independent frame, so the result can be decompressed in parallel
+        """
+        params = {
+            "level": level,
+            "long_distance": long_distance,
+            "window_log": window_log,
+            "dictionary": dictionary,
+        }
+        if frame_size:
+            # COMPRESS THE FRAMES ON threads WORKERS, EACH IS SINGLE-THREADED
+            source = self.reader
+
+            def read():
+                try:
+                    inputs = iter(lambda: source.read(frame_size), b"")
+                    if threads:
+                        frames = ((data, params) for data in inputs)
+                        workers = threads if threads > 0 else os.cpu_count()
+                        for _, future in pool_iter(compress_frame, frames, workers=workers):
+                            yield future.result()
+                    else:
+                        compressor = new_compressor(**params)
+                        for data in inputs:
+                            yield compressor.compress(data)
+                finally:
+                    source.close()
+
+            return ByteStream(Reader(read()))
+
+        compressor = new_compressor(threads=threads, **params)
+        return ByteStream(compressor.stream_reader(self.reader, **({"read_size": read_size} if read_size else {})))
+
+    def utf8(self, *, chunk_size=DECODE_CHUNK_SIZE, errors="strict"):
+        return self.decode("utf8", chunk_size=chunk_size, errors=errors)
+
+    def decode(self, encoding="utf8", *, chunk_size=DECODE_CHUNK_SIZE, errors="strict"):
+        """
+        RETURN StringStream, DECODED INCREMENTALLY, SO CHARACTERS CAN STRADDLE CHUNKS
+        :param encoding: any Python codec
+        :param chunk_size: most bytes decoded at a time
+        :param errors: "strict", "replace", "ignore", etc (see codecs)
+        """
+        decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+
+        def read():
+            try:
+                for data in chunk_views(self.reader, chunk_size):
+                    text = decoder.decode(data)
+                    if text:
+                        yield text
+                text = decoder.decode(b"", final=True)
+                if text:
+                    yield text
+            finally:
+                self.reader.close()
 
         return StringStream(read())
 
-    def lines(self):
-        return self.utf8().lines()
+    def lines(self, encoding="utf8"):
+        """
+        RETURN STREAM OF LINES (WITHOUT THE \\n)
+        :param encoding: encoding of the bytes, None TO RETURN bytes LINES
+        """
+        if encoding and "\n".encode(encoding) != b"\n":
+            # BYTE-LEVEL SPLIT IS NOT POSSIBLE
+            return self.decode(encoding).lines()
+        reader = self.reader
+        if isinstance(reader, MmapReader):
+            # SCAN THE MAPPING DIRECTLY
+            lines = reader.lines(encoding)
+        elif encoding:
+            lines = decode_lines(chunk_bytes(reader, LINE_CHUNK_SIZE), encoding)
+        else:
+            lines = split_lines(chunk_bytes(reader, LINE_CHUNK_SIZE), b"\n")
+
+        def read():
+            try:
+                for line in lines:
+                    yield line, {}
+            finally:
+                reader.close()
+
+        return ObjectStream(read(), Typer(python_type=str if encoding else bytes), JxType())
+
+    def csv(self, encoding="utf8", **kwargs):
+        """
+        RETURN STREAM OF CSV ROWS, FIRST ROW IS THE HEADER (SEE StringStream.csv)
+        """
+        return self.decode(encoding).csv(**kwargs)
+
+    def jsonl(self, *, sample_size=SAMPLE_SIZE):
+        """
+        RETURN STREAM OF JSON VALUES, ONE PER LINE (BLANK LINES ARE IGNORED, BAD LINES ARE Null)
+        :param sample_size: number of values read (when the schema is first needed) to infer the schema
+        """
+        lines = self.lines(encoding=None)._iter
+
+        def read():
+            # EACH LINE IS DECODED ON ITS OWN, SO A BAD LINE CAN NOT CHANGE ITS NEIGHBOURS
+            loads = get_json_loads()
+            try:
+                for line, _ in lines:
+                    if line.strip():
+                        yield to_data(_loads(loads, line)), {}
+            finally:
+                close_iter(lines)
+
+        return _infer_stream(read(), sample_size)
+
+    def json(self, query_path=None, *, sample_size=SAMPLE_SIZE):
+        """
+        RETURN STREAM OF THE MEMBERS OF THE ARRAY AT query_path, WITHOUT LOADING THE WHOLE DOCUMENT
+        :param query_path: dot-delimited path to the array (None for a top-level array)
+        :param sample_size: number of values read (when the schema is first needed) to infer the schema
+        """
+        path = query_path or "."
+        reader = self.reader
+
+        def read():
+            try:
+                for record in parse(reader, path, {path}):
+                    yield record[path], {}
+            finally:
+                reader.close()
+
+        return _infer_stream(read(), sample_size)
 
     def chunk(self, size=8192):
         return ObjectStream(chunk_bytes(self.reader, size), b"", bytes, {}, JxType())
 
+    @terminator
     def write(self, file):
         file = File(file)
         with open(file.os_path, "wb") as f:
-            for d in chunk_bytes(self.reader):
+            for d in chunk_views(self.reader, MMAP_CHUNK_SIZE):
                 f.write(d)
 
+    @terminator
     def to_bytes(self):
-        return b"".join(chunk_bytes(self.reader))
+        return b"".join(chunk_views(self.reader, MMAP_CHUNK_SIZE))
+
+    def prefetch(self, size, *, chunk_size=DECODE_CHUNK_SIZE):
+        """
+        READ (AND DECOMPRESS) IN A BACKGROUND THREAD, UP TO size CHUNKS AHEAD, SO I/O AND COMPUTE OVERLAP
+        :param chunk_size: bytes to read at a time (for file-like readers)
+        """
+        return ByteStream(Reader(prefetch_iter(chunk_bytes(self.reader, chunk_size), size)))
+
+    def to_async(self):
+        """
+        RETURN AsyncByteStream, THIS STREAM IS READ IN A THREAD
+        """
+        return AsyncByteStream(offload(chunk_bytes(self.reader, DECODE_CHUNK_SIZE), batch_size=16))
+
+    @terminator
+    def to_s3(self, *, name, bucket, part_size=PART_SIZE, workers=WORKERS, client=None):
+        """
+        MULTIPART UPLOAD
+        :param name: the key of the s3 object
+        :param part_size: bytes per part
+        :param workers: number of parts uploaded at once
+        :param client: boto3 s3 client (default is a shared, pooled, client)
+        """
+        upload(self.reader, bucket=bucket, key=name, part_size=part_size, workers=workers, client=client)
+
+
+def _spill(reader):
+    """
+    COPY THE NON-SEEKABLE reader TO A TEMPORARY FILE, AND RETURN THAT FILE
+    """
+    file = TemporaryFile()
+    try:
+        for chunk in chunk_bytes(reader):
+            file.write(chunk)
+        file.seek(0)
+    except Exception:
+        file.close()
+        raise
+    return file
+
 
-    def to_s3(self, *, name, bucket):
-        import boto3
+def _read_member(archive, name):
+    # zlib RELEASES THE GIL, SO MEMBERS DECOMPRESS IN PARALLEL
+    with archive.open(name, "r") as member:
+        return member.read()
 
-        s3_client = boto3.client("s3")
+
+def _infer_stream(values, sample_size):
+    """
+    RETURN ObjectStream OF values, WITH TYPE INFERRED FROM THE FIRST sample_size
+    NOTHING IS READ UNTIL THE TYPE IS NEEDED, OR THE STREAM IS READ
+    """
+    sample = []
+    type_ = []
+
+    def get_type():
+        if not type_:
+            sample.extend(islice(values, sample_size))
+            type_.append(infer_jx_type(v for v, _ in sample))
+        return type_[0]
+
+    def read():
         try:
-            return s3_client.upload_fileobj(self.reader, bucket, name)
-        except Exception as cause:
-            if self.verbose:
-                logger.warning("problem with s3 upload", cause=cause)
+            get_type()
+            yield from sample
+            sample.clear()
+            yield from values
+        finally:
+            close_iter(values)
+
+    return ObjectStream(read(), LiveJxTyper(get_type), JxType())
+
+
+def _loads(loads, line):
+    try:
+        return loads(line)
+    except Exception as cause:
+        DEBUG and logger.warning("can not decode {{line|quote}}", line=line, cause=cause)
+        return None
+
+
+_json_loads = None
+
+
+def get_json_loads():
+    """
+    RETURN THE FASTEST JSON DECODER INSTALLED (orjson, OR THE STANDARD LIBRARY)
+    """
+    global _json_loads
+    if _json_loads is None:
+        try:
+            from orjson import loads
+
+            _json_loads = loads
+        except ImportError:
+            from json import loads
+
+            _json_loads = loads
+    return _json_loads
 
 
 export("mo_streams._utils", ByteStream)
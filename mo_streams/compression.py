@@ -0,0 +1,87 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import re
+from itertools import chain
+
+from mo_logs import logger
+
+from mo_streams._utils import Reader, chunk_bytes
+
+# (PATTERN OVER THE FIRST BYTES, ByteStream METHOD TO DECOMPRESS)
+MAGIC = [
+    (re.compile(re.escape(b"\x1f\x8b")), "from_gzip"),
+    (re.compile(b"BZh[1-9]" + re.escape(b"\x31\x41\x59\x26\x53\x59")), "from_bz2"),
+    (re.compile(re.escape(b"\xfd7zXZ\x00")), "from_xz"),
+    (re.compile(re.escape(b"\x28\xb5\x2f\xfd")), "from_zst"),
+    (re.compile(re.escape(b"\x04\x22\x4d\x18")), "from_lz4"),
+]
+MAGIC_SIZE = 10
+
+# FASTEST FIRST, ALL HAVE THE gzip.open() SIGNATURE
+GZIP_BACKENDS = ["isal.igzip", "zlib_ng.gzip_ng", "gzip"]
+
+
+def sniff(reader):
+    """
+    RETURN (NAME OF DECOMPRESSING METHOD, OR None), AND A READER THAT STILL STARTS AT THE BEGINNING
+    """
+    head, reader = peek(reader, MAGIC_SIZE)
+    for pattern, method in MAGIC:
+        if pattern.match(head):
+            return method, reader
+    return None, reader
+
+
+def peek(reader, size):
+    """
+    RETURN THE FIRST size BYTES, AND A READER THAT STILL STARTS AT THE BEGINNING
+    """
+    if reader.seekable():
+        position = reader.tell()
+        head = reader.read(size)
+        reader.seek(position)
+        return head, reader
+    parts = []
+    remaining = size
+    while remaining:
+        data = reader.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    head = b"".join(parts)
+    return head, Reader(chain([head], chunk_bytes(reader)))
+
+
+_gzip = None
+
+
+def get_gzip():
+    """
+    RETURN THE FASTEST gzip MODULE INSTALLED
+    """
+    global _gzip
+    if _gzip is None:
+        for name in GZIP_BACKENDS:
+            try:
+                module = __import__(name, fromlist=["open"])
+                _gzip = module
+                break
+            except ImportError:
+                continue
+    return _gzip
+
+
+def get_lz4():
+    try:
+        import lz4.frame
+
+        return lz4.frame
+    except ImportError as cause:
+        logger.error("lz4 is not installed (pip install lz4)", cause=cause)
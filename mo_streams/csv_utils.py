@@ -0,0 +1,219 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import csv
+from datetime import datetime
+from io import StringIO
+from itertools import islice, chain, zip_longest, repeat
+
+from mo_dots import is_data, is_many
+from mo_json import value2json
+from mo_logs import logger
+
+DEBUG = False
+
+BATCH_SIZE = 1024
+SAMPLE_SIZE = 1000
+OUTPUTS = ("dict", "tuple", "columns")
+
+
+def csv_lines(chunks):
+    """
+    RETURN GENERATOR OF LINES, WITH THEIR LINE ENDING (SO csv CAN SEE NEWLINES IN QUOTED VALUES)
+    EACH CHUNK IS SPLIT BY StringIO, ONLY THE PARTIAL LAST LINE IS CARRIED TO THE NEXT CHUNK
+    """
+    tail = []
+    for chunk in chunks:
+        end = chunk.rfind("\n") + 1
+        if not end:
+            tail.append(chunk)
+            continue
+        tail.append(chunk[:end])
+        yield from StringIO("".join(tail), newline="\n")
+        tail = [chunk[end:]]
+    tail = "".join(tail)
+    if tail:
+        yield tail
+
+
+def read_csv(chunks, *, infer_types=False, output="dict", sample_size=SAMPLE_SIZE, batch_size=BATCH_SIZE, **fmtparams):
+    """
+    PARSE CSV FROM str CHUNKS, FIRST ROW IS THE HEADER
+    :param chunks: generator of str
+    :param infer_types: True to convert columns to bool, int, float or datetime, based on the first sample_size rows
+                        (a column with a later value that does not convert is str from that batch on)
+    :param output: "dict" for one dict per row, "tuple" for one tuple per row, "columns" for one dict of lists per batch
+    :param sample_size: number of rows used to infer the types
+    :param batch_size: number of rows converted at a time
+    :param fmtparams: passed to csv.reader (like delimiter)
+    :return: (column names, dict from name to python type, generator of members)
+             (the dict is updated when a column falls back to str)
+    """
+    if output not in OUTPUTS:
+        logger.error("expecting output to be one of {{outputs}}, not {{output|quote}}", outputs=OUTPUTS, output=output)
+    # BLANK LINES ARE SKIPPED, LIKE csv.DictReader
+    reader = filter(None, csv.reader(csv_lines(chunks), **fmtparams))
+    names = next(reader, [])
+    width = len(names)
+    if infer_types:
+        sample = list(islice(reader, sample_size))
+        conversions = [_infer(column) for column in _columns(sample, width)]
+        reader = chain(sample, reader)
+    else:
+        conversions = [(str, None)] * width
+    types = {n: t for n, (t, _) in zip(names, conversions)}
+
+    def read():
+        while True:
+            rows = list(islice(reader, batch_size))
+            if not rows:
+                return
+            if output == "dict" and not infer_types:
+                # FAST PATH, NO CONVERSION
+                yield from _dicts(names, rows, rows)
+                continue
+            columns = []
+            for i, column in enumerate(_columns(rows, width)):
+                converted = _convert(conversions[i][1], column)
+                if converted is None:
+                    # A VALUE DOES NOT FIT THE INFERRED TYPE
+                    DEBUG and logger.warning("column {{name|quote}} is now str", name=names[i])
+                    conversions[i] = (str, None)
+                    types[names[i]] = str
+                    converted = list(column)
+                columns.append(converted)
+            if output == "dict":
+                yield from _dicts(names, zip(*columns), rows)
+            elif output == "tuple":
+                yield from zip(*columns)
+            else:
+                yield dict(zip(names, columns))
+
+    return names, types, read()
+
+
+def write_csv(rows, columns, *, batch_size=BATCH_SIZE, encoding="utf8", **fmtparams):
+    """
+    RETURN GENERATOR OF bytes, ONE CHUNK FOR THE HEADER AND EACH batch_size ROWS
+    :param rows: generator of dicts (or Data), or tuples in column order
+    :param columns: list of column names
+    NESTED CELLS (dicts AND lists) ARE WRITTEN AS JSON
+    :param fmtparams: passed to csv.writer (default lineterminator is \\n)
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, **{"lineterminator": "\n", **fmtparams})
+    writer.writerow(columns)
+    yield buffer.getvalue().encode(encoding)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        buffer.seek(0)
+        buffer.truncate()
+        if isinstance(batch[0], (tuple, list)):
+            writer.writerows([[_cell(v) for v in row] for row in batch])
+        else:
+            writer.writerows([[_cell(row.get(c)) for c in columns] for row in batch])
+        yield buffer.getvalue().encode(encoding)
+
+
+def _cell(value):
+    if is_data(value) or is_many(value):
+        return value2json(value)
+    return value
+
+
+def _columns(rows, width):
+    """
+    TRANSPOSE rows TO width COLUMNS, SHORT ROWS ARE FILLED WITH None
+    """
+    columns = list(zip_longest(*rows))[:width]
+    size = len(rows)
+    while len(columns) < width:
+        columns.append((None,) * size)
+    return columns
+
+
+def _dicts(names, values, rows):
+    """
+    RETURN THE ROWS AS dicts, LIKE csv.DictReader: SHORT ROWS ARE FILLED WITH None, EXTRA CELLS ARE A list UNDER None
+    :param values: the (maybe converted) cells of each row
+    :param rows: the raw rows, for the extra cells
+    """
+    width = len(names)
+    if set(map(len, rows)) == {width}:
+        return map(dict, map(zip, repeat(names), values))
+    return [_dict(names, v, row, width) for v, row in zip(values, rows)]
+
+
+def _dict(names, values, row, width):
+    record = dict(zip_longest(names, values[:width]))
+    if len(row) > width:
+        record[None] = row[width:]
+    return record
+
+
+def _convert(convert, column):
+    """
+    RETURN THE CONVERTED column, OR None IF A VALUE DOES NOT CONVERT
+    """
+    if convert is None:
+        return list(column)
+    try:
+        # WHEN NO VALUES ARE MISSING, THE BUILTIN CAN BE MAPPED DIRECTLY
+        return FAST[convert](column)
+    except Exception:
+        pass
+    try:
+        return list(map(convert, column))
+    except Exception as cause:
+        DEBUG and logger.warning("can not convert column", cause=cause)
+        return None
+
+
+def _to_bool(value):
+    return BOOLEANS[value.lower()] if value else None
+
+
+def _to_int(value):
+    return int(value) if value else None
+
+
+def _to_float(value):
+    return float(value) if value else None
+
+
+def _to_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+BOOLEANS = {"true": True, "false": False}
+CANDIDATES = [(bool, _to_bool), (int, _to_int), (float, _to_float), (datetime, _to_datetime)]
+FAST = {
+    _to_bool: lambda column: list(map(BOOLEANS.__getitem__, map(str.lower, column))),
+    _to_int: lambda column: list(map(int, column)),
+    _to_float: lambda column: list(map(float, column)),
+    _to_datetime: lambda column: list(map(datetime.fromisoformat, column)),
+}
+
+
+def _infer(column):
+    """
+    RETURN (type, converter) FOR THE FIRST CANDIDATE THAT CONVERTS ALL VALUES
+    """
+    values = [v for v in column if v]
+    if not values:
+        return str, None
+    for type_, convert in CANDIDATES:
+        try:
+            for v in values:
+                convert(v)
+            return type_, convert
+        except Exception:
+            continue
+    return str, None
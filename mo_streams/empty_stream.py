@@ -13,6 +13,7 @@ from mo_streams.type_utils import Typer
 
 from mo_streams.object_stream import ObjectStream
 from mo_streams._utils import Stream
+from mo_streams.async_stream import AsyncObjectStream, offload
 
 
 class EmptyStream(Stream):
@@ -46,6 +47,9 @@ class EmptyStream(Stream):
     def last(self):
         return None
 
+    def to_async(self):
+        return AsyncObjectStream(offload(iter([])), Typer(), JX_IS_NULL)
+
 
 def return_self(self, *args, **kwargs):
     return self
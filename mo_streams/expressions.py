@@ -0,0 +1,380 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import keyword
+import operator
+from itertools import repeat
+
+from mo_dots import is_missing
+from mo_logs import logger, strings
+
+OPERATORS = {
+    "==": operator.eq,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "+": operator.add,
+    "-": operator.sub,
+    "%": operator.mod,
+}
+
+NUMBER_TYPES = {int, float}
+
+
+class Scalar:
+    """
+    ONE VALUE FOR THE WHOLE BATCH
+    """
+
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+
+def evaluate_batch(expr, values, columns):
+    """
+    EVALUATE expr OVER A WHOLE BATCH
+    :param expr: expression tree, as found on built functions (see function_factory.py)
+    :param values: list of stream members
+    :param columns: dict from attachment name to list of attachment values
+    :return: list with one result for each member
+    """
+    result = _evaluate(expr, values, columns)
+    if isinstance(result, Scalar):
+        return [result.value] * len(values)
+    return result
+
+
+def _evaluate(expr, values, columns):
+    op = expr[0]
+    if op == "it":
+        return values
+    elif op == "const":
+        return Scalar(expr[1])
+    elif op == "attach":
+        column = columns.get(expr[1])
+        if column is None:
+            return Scalar(None)
+        return column
+    elif op == "getattr":
+        getter = operator.attrgetter(expr[2])
+        return _apply(getter, _evaluate(expr[1], values, columns))
+    elif op == "getitem":
+        source = _evaluate(expr[1], values, columns)
+        key = _evaluate(expr[2], values, columns)
+        if isinstance(key, Scalar):
+            return _apply(operator.itemgetter(key.value), source)
+        return _apply2(operator.getitem, source, key)
+    elif op == "op":
+        return _apply2(OPERATORS[expr[1]], _evaluate(expr[2], values, columns), _evaluate(expr[3], values, columns))
+    elif op == "div":
+        left, right = _evaluate(expr[1], values, columns), _evaluate(expr[2], values, columns)
+        if _is_numeric(left) and _is_numeric(right):
+            # NUMBERS ARE NEVER MISSING
+            return _apply2(operator.truediv, left, right)
+        return _apply2(_div, left, right)
+    elif op == "call":
+        callee = _evaluate(expr[1], values, columns)
+        args = [_evaluate(a, values, columns) for a in expr[2]]
+        kwargs = {k: _evaluate(v, values, columns) for k, v in expr[3]}
+        return _call(callee, args, kwargs, len(values))
+    elif op == "func":
+        func = expr[1]
+        return [func(v, a) for v, a in zip(values, rows(values, columns))]
+    logger.error("unknown expression {{op|quote}}", op=op)
+
+
+def vectorize(expr):
+    """
+    RETURN True IF expr CAN BE EVALUATED WITH NUMPY, WHEN THE BATCH IS NUMERIC
+    """
+    op = expr[0]
+    if op in ("it", "attach"):
+        return True
+    elif op == "const":
+        value = expr[1]
+        return type(value) is float or (type(value) is int and abs(value) < INT_LIMIT)
+    elif op == "op":
+        return expr[1] in OPERATORS and vectorize(expr[2]) and vectorize(expr[3])
+    elif op == "div":
+        return vectorize(expr[1]) and vectorize(expr[2])
+    return False
+
+
+def calls_user_code(expr):
+    """
+    RETURN True IF expr CALLS CODE GIVEN BY THE USER, WHICH MAY HAVE SIDE EFFECTS, SO MUST RUN ONCE PER MEMBER
+    """
+    op = expr[0]
+    if op in ("call", "func"):
+        return True
+    elif op in ("it", "const", "attach"):
+        return False
+    elif op == "op":
+        return calls_user_code(expr[2]) or calls_user_code(expr[3])
+    return calls_user_code(expr[1]) or calls_user_code(expr[2])
+
+
+def evaluate_numpy(expr, values, columns):
+    """
+    EVALUATE expr OVER NUMPY ARRAYS
+    :return: array of results, or None IF THE BATCH IS NOT NUMERIC (OR NOT SAFE TO VECTORIZE)
+    """
+    numpy = get_numpy()
+    if not numpy:
+        return None
+
+    def arrays(e):
+        op = e[0]
+        if op == "it":
+            return as_array(values)
+        elif op == "attach":
+            column = columns.get(e[1])
+            return None if column is None else as_array(column)
+        elif op == "const":
+            return e[1]
+        left = arrays(e[2] if op == "op" else e[1])
+        right = arrays(e[3] if op == "op" else e[2])
+        if left is None or right is None:
+            return None
+        if op == "div":
+            if _has_zero(right):
+                # PYTHON RAISES, NUMPY RETURNS inf
+                return None
+            if not _small_ints(left, right, limit=FLOAT_LIMIT):
+                # PYTHON DIVIDES HUGE int EXACTLY
+                return None
+            return numpy.true_divide(left, right)
+        symbol = e[1]
+        if symbol == "%" and _has_zero(right):
+            return None
+        if symbol in ("+", "-") and not _small_ints(left, right):
+            # int64 CAN OVERFLOW, PYTHON int CAN NOT
+            return None
+        if not _exact_floats(left, right):
+            # NUMPY COMPARES int WITH float AS float, PYTHON COMPARES EXACTLY
+            return None
+        return OPERATORS[symbol](left, right)
+
+    result = arrays(expr)
+    if result is None or not isinstance(result, numpy.ndarray):
+        return None
+    return result
+
+
+_numpy = None
+
+
+def get_numpy():
+    """
+    RETURN numpy MODULE, OR False IF NOT INSTALLED
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def as_array(values):
+    """
+    RETURN values AS A NUMERIC ARRAY, OR None IF THE CONVERSION IS NOT EXACT
+    ONLY A BATCH OF ALL int, OR ALL float, IS CONVERTED; bool, MIXED, AND HUGE int ARE NOT
+    """
+    numpy = get_numpy()
+    if isinstance(values, numpy.ndarray):
+        # bool HAS DIFFERENT ARITHMETIC, object IS NOT FAST
+        return values if values.dtype.kind in "iuf" else None
+    types = set(map(type, values))
+    if types == {int}:
+        try:
+            return numpy.fromiter(values, dtype=numpy.int64, count=len(values))
+        except OverflowError:
+            return None
+    if types == {float}:
+        return numpy.fromiter(values, dtype=numpy.float64, count=len(values))
+    return None
+
+
+def to_list(values):
+    """
+    RETURN PYTHON list, CONVERTING NUMPY ARRAYS TO PYTHON VALUES
+    """
+    if isinstance(values, list):
+        return values
+    return values.tolist()
+
+
+def _has_zero(value):
+    if isinstance(value, (int, float)):
+        return value == 0
+    return not value.all()
+
+
+def _small_ints(*values, limit=None):
+    limit = limit or INT_LIMIT
+    for value in values:
+        if isinstance(value, float):
+            continue
+        if isinstance(value, int):
+            if abs(value) >= limit:
+                return False
+            continue
+        if value.dtype.kind == "f" or not len(value):
+            continue
+        if max(abs(int(value.max())), abs(int(value.min()))) >= limit:
+            return False
+    return True
+
+
+def _exact_floats(left, right):
+    """
+    RETURN True IF NO int IS ROUNDED WHEN MIXED WITH A float
+    """
+    kinds = {_kind(left), _kind(right)}
+    if kinds != {"i", "f"}:
+        return True
+    return _small_ints(*(v for v in (left, right) if _kind(v) == "i"), limit=FLOAT_LIMIT)
+
+
+def _kind(value):
+    if isinstance(value, float):
+        return "f"
+    if isinstance(value, int):
+        return "i"
+    return "f" if value.dtype.kind == "f" else "i"
+
+
+INT_LIMIT = 2 ** 62
+FLOAT_LIMIT = 2 ** 53  # LARGEST int EXACT AS float
+
+
+def rows(values, columns):
+    """
+    RETURN THE ATTACHMENT dict FOR EACH MEMBER
+    """
+    if not columns:
+        return [{} for _ in values]
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def _is_numeric(source):
+    if isinstance(source, Scalar):
+        return type(source.value) in NUMBER_TYPES
+    return set(map(type, source)) <= NUMBER_TYPES
+
+
+def _div(sv, ov):
+    if is_missing(sv) or is_missing(ov):
+        return None
+    return sv / ov
+
+
+def _apply(func, source):
+    if isinstance(source, Scalar):
+        return Scalar(func(source.value))
+    return list(map(func, source))
+
+
+def _apply2(func, left, right):
+    if isinstance(left, Scalar):
+        if isinstance(right, Scalar):
+            return Scalar(func(left.value, right.value))
+        return list(map(func, repeat(left.value), right))
+    if isinstance(right, Scalar):
+        return list(map(func, left, repeat(right.value)))
+    return list(map(func, left, right))
+
+
+def _call(callee, args, kwargs, size):
+    if isinstance(callee, Scalar) and all(isinstance(a, Scalar) for a in args) and not kwargs:
+        # EVEN WITH CONSTANT PARAMETERS, THE CALL IS MADE FOR EACH MEMBER
+        func, params = callee.value, [a.value for a in args]
+        return [func(*params) for _ in range(size)]
+    callees = repeat(callee.value, size) if isinstance(callee, Scalar) else callee
+    params = [repeat(a.value, size) if isinstance(a, Scalar) else a for a in args]
+    if not kwargs:
+        if isinstance(callee, Scalar):
+            return list(map(callee.value, *params))
+        return list(map(lambda f, *p: f(*p), callees, *params))
+    names = list(kwargs)
+    kw_params = [repeat(v.value, size) if isinstance(v, Scalar) else v for v in kwargs.values()]
+    return [
+        f(*p[: len(params)], **dict(zip(names, p[len(params) :])))
+        for f, *p in zip(callees, *params, *kw_params)
+    ]
+
+
+_makers = {}
+
+
+def compile_expression(expr):
+    """
+    RETURN ONE PYTHON FUNCTION OF (v, a) THAT COMPUTES expr, WITHOUT A CLOSURE FOR EACH NODE
+    THE GENERATED CODE IS CACHED BY EXPRESSION STRUCTURE; CONSTANTS ARE PASSED IN
+    """
+    constants = []
+
+    def const(value):
+        constants.append(value)
+        return f"c{len(constants) - 1}"
+
+    def gen(e):
+        op = e[0]
+        if op == "it":
+            return "v"
+        elif op == "const":
+            return const(e[1])
+        elif op == "attach":
+            return f"a[{const(e[1])}]"
+        elif op == "getattr":
+            name = e[2]
+            if name.isidentifier() and not keyword.iskeyword(name):
+                return f"{gen(e[1])}.{name}"
+            return f"getattr({gen(e[1])}, {const(name)})"
+        elif op == "getitem":
+            return f"{gen(e[1])}[{gen(e[2])}]"
+        elif op == "op":
+            return f"({gen(e[2])} {e[1]} {gen(e[3])})"
+        elif op == "div":
+            return f"_div({gen(e[1])}, {gen(e[2])})"
+        elif op == "call":
+            params = [gen(a) for a in e[2]]
+            if e[3]:
+                params.append("**{" + ", ".join(f"{const(k)}: {gen(v)}" for k, v in e[3]) + "}")
+            return f"{gen(e[1])}({', '.join(params)})"
+        elif op == "func":
+            return f"{const(e[1])}(v, a)"
+        logger.error("unknown expression {{op|quote}}", op=op)
+
+    body = gen(expr)
+    maker = _makers.get(body)
+    if maker is None:
+        names = "".join(f", c{i}" for i in range(len(constants)))
+        source = strings.outdent(
+            f"""
+            def make(_div{names}):
+                def compiled(v, a):
+                    return {body}
+                return compiled
+            """
+        )
+        namespace = {}
+        exec(source, {}, namespace)
+        maker = _makers[body] = namespace["make"]
+    func = maker(_div, *constants)
+    setattr(func, "source", body)
+    setattr(func, "expr", expr)
+    return func
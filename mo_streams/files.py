@@ -11,13 +11,17 @@ from mo_files import File
 from mo_imports import export
 
 from mo_future import extend
-from mo_streams._utils import ByteStream
+from mo_streams._utils import ByteStream, open_file
 
 DECODERS = {
     "zst": ByteStream.from_zst,
     "tar": ByteStream.from_tar,
     "zip": ByteStream.from_zip,
-    # "gzip": gzip_stream
+    "gz": ByteStream.from_gzip,
+    "gzip": ByteStream.from_gzip,
+    "bz2": ByteStream.from_bz2,
+    "xz": ByteStream.from_xz,
+    "lz4": ByteStream.from_lz4,
 }
 
 
@@ -30,23 +34,26 @@ def _get_file_stream(file, stream):
     name, extension = _get_extension(file)
     decoder = DECODERS.get(extension, None)
     if not decoder:
+        if isinstance(stream, ByteStream):
+            # COMPRESSED CONTENT WITHOUT THE EXTENSION
+            return stream.decompress()
         return stream
     return _get_file_stream(name, decoder(stream))
 
 
 @extend(File)
 def content(self):
-    return _get_file_stream(self.os_path, ByteStream(open(self.os_path, "rb")))
+    return _get_file_stream(self.os_path, ByteStream(open_file(self.os_path)))
 
 
 @extend(File)
 def stream(self):
-    return _get_file_stream(self.os_path, ByteStream(open(self.os_path, "rb")))
+    return _get_file_stream(self.os_path, ByteStream(open_file(self.os_path)))
 
 
 @extend(File)
 def bytes(self):
-    return ByteStream(open(self.os_path, "rb"))
+    return ByteStream(open_file(self.os_path))
 
 
 def _get_extension(file_name):
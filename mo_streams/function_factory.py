@@ -16,6 +16,7 @@ from mo_imports import expect
 from mo_logs import logger, Except, strings
 from mo_logs.exceptions import ERROR, get_stacktrace
 
+from mo_streams.expressions import compile_expression
 from mo_streams.type_utils import Typer, LazyTyper, CallableTyper, UnknownTyper
 
 DEBUG = False
@@ -29,6 +30,44 @@ _set = object.__setattr__
 BuiltFunction = namedtuple("BuiltFunction", ["function", "return_type", "schema"])
 NO_ARGS = BuiltFunction(tuple(), tuple(), tuple())
 
+# BUILT FUNCTIONS CARRY AN expr ATTRIBUTE, SO THEY CAN BE EVALUATED IN OTHER WAYS (LIKE OVER A BATCH)
+#   ("it",)                                  THE STREAM MEMBER
+#   ("const", value)                         A CONSTANT
+#   ("attach", name)                         AN ATTACHMENT
+#   ("getattr", expr, name)                  ATTRIBUTE OF expr
+#   ("getitem", expr, expr)                  ITEM OF expr
+#   ("op", symbol, expr, expr)               BINARY OPERATOR
+#   ("div", expr, expr)                      DIVISION, None IF EITHER IS MISSING
+#   ("call", expr, (expr,...), ((name, expr),...))
+#   ("func", function)                       OPAQUE FUNCTION OF (value, attachments)
+
+
+def expression_of(func):
+    """
+    RETURN THE EXPRESSION FOR THE BUILT FUNCTION
+    """
+    return getattr(func, "expr", None) or ("func", func)
+
+
+def with_expr(func, expr):
+    setattr(func, "expr", expr)
+    return func
+
+
+def constant(value):
+    return with_expr(lambda v, a: value, ("const", value))
+
+
+def compiled(built: BuiltFunction) -> BuiltFunction:
+    """
+    REPLACE THE CHAIN OF BUILT CLOSURES WITH ONE GENERATED FUNCTION
+    """
+    expr = getattr(built.function, "expr", None)
+    if DEBUG or not expr or expr[0] in ("it", "func"):
+        # DEBUG NEEDS THE LOGGING CLOSURES
+        return built
+    return BuiltFunction(compile_expression(expr), built.return_type, built.schema)
+
 
 class FunctionFactory:
     """
@@ -55,6 +94,7 @@ class FunctionFactory:
                     finally:
                         DEBUG and logger.info("run {{source}}", source=source)
 
+                with_expr(get_schema_item, ("attach", item))
                 return BuiltFunction(get_schema_item, domain_schema[item], domain_schema)
             elif isinstance(item, FunctionFactory):
                 fi, ti, si = _get(item, "build")(domain_type, domain_schema)
@@ -65,6 +105,7 @@ class FunctionFactory:
                     finally:
                         DEBUG and logger.info("run {{source}}", source=source)
 
+                with_expr(get_func_item, ("getitem", expression_of(f), expression_of(fi)))
                 return BuiltFunction(get_func_item, UnknownTyper(Exception("too complicated to know type")), s)
             else:
 
@@ -74,6 +115,7 @@ class FunctionFactory:
                     finally:
                         DEBUG and logger.info("run {{source}}", source=source)
 
+                with_expr(get_const_item, ("getitem", expression_of(f), ("const", item)))
                 return BuiltFunction(get_const_item, t[item], s)
 
         return FunctionFactory(builder, _get(self, "typer")[item], source)
@@ -92,6 +134,7 @@ class FunctionFactory:
                     finally:
                         DEBUG and logger.info("run {{source}}", source=source)
 
+                with_expr(get_schema_item, ("attach", item))
                 return BuiltFunction(get_schema_item, domain_schema[item], domain_schema)
             elif isinstance(item, FunctionFactory):
                 f, t, s = item.build(domain_type, domain_schema)
@@ -111,6 +154,7 @@ class FunctionFactory:
                     finally:
                         DEBUG and logger.info("run {{source}}", source=source)
 
+                with_expr(get_const_item, ("getattr", expression_of(f), item))
                 return BuiltFunction(get_const_item, getattr(t, item), s)
 
         return FunctionFactory(builder, getattr(_get(self, "typer"), item), source)
@@ -125,6 +169,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) == of(v, a)
 
+            with_expr(func, ("op", "==", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=bool), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=bool), f"{other} == {self}")
@@ -139,6 +184,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) > of(v, a)
 
+            with_expr(func, ("op", ">", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=bool), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=bool), f"{other} > {self}")
@@ -153,6 +199,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) >= of(v, a)
 
+            with_expr(func, ("op", ">=", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=bool), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=bool), f"{other} >= {self}")
@@ -167,6 +214,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) < of(v, a)
 
+            with_expr(func, ("op", "<", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=bool), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=bool), f"{other} < {self}")
@@ -181,6 +229,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) <= of(v, a)
 
+            with_expr(func, ("op", "<=", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=bool), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=bool), f"{other} <= {self}")
@@ -199,6 +248,7 @@ class FunctionFactory:
                     return None
                 return sv / ov
 
+            with_expr(func, ("div", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, Typer(python_type=float), domain_schema)
 
         return FunctionFactory(builder, Typer(python_type=float), f"{other} / {self}")
@@ -213,6 +263,7 @@ class FunctionFactory:
             def func(v, a):
                 return of(v, a) - sf(v, a)
 
+            with_expr(func, ("op", "-", expression_of(of), expression_of(sf)))
             return BuiltFunction(func, st, domain_schema)
 
         type_ = Typer(example=other) + _get(self, "typer")
@@ -228,6 +279,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) + of(v, a)
 
+            with_expr(func, ("op", "+", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, st+ot, domain_schema)
 
         type_ = _get(self, "typer") + _get(other, "typer")
@@ -243,6 +295,7 @@ class FunctionFactory:
             def func(v, a):
                 return of(v, a) + sf(v, a)
 
+            with_expr(func, ("op", "+", expression_of(of), expression_of(sf)))
             return BuiltFunction(func, st, domain_schema)
 
         type_ = Typer(example=other) + _get(self, "typer")
@@ -258,6 +311,7 @@ class FunctionFactory:
             def func(v, a):
                 return sf(v, a) % of(v, a)
 
+            with_expr(func, ("op", "%", expression_of(sf), expression_of(of)))
             return BuiltFunction(func, st, domain_schema)
 
         type_ = _get(self, "typer") % _get(func_other, "typer")
@@ -292,6 +346,15 @@ class FunctionFactory:
                     )
 
             setattr(func, "source", source)
+            with_expr(
+                func,
+                (
+                    "call",
+                    expression_of(sf),
+                    tuple(expression_of(f) for f in _args.function),
+                    tuple((k, expression_of(f)) for k, f in _kwargs.items()),
+                ),
+            )
 
             return BuiltFunction(func, st(*_args.return_type), domain_schema)
 
@@ -307,7 +370,7 @@ def factory(item, return_type=None):
 
     # CONSTANT
     def build_constant(domain_type, domain_schema) -> BuiltFunction:
-        return BuiltFunction(lambda v, a: item, Typer(example=item), domain_schema)
+        return BuiltFunction(constant(item), Typer(example=item), domain_schema)
 
     return FunctionFactory(build_constant, Typer(example=item), f"{item}")
 
@@ -322,7 +385,7 @@ def normalize(item, *, domain_type=None, return_type=None):
     if isinstance(item, (str, bytes, bool, int, float)):
         # CONSTANT
         def build_constant(domain_type, domain_schema) -> BuiltFunction:
-            return BuiltFunction(lambda v, a: item, Typer(example=item), domain_schema)
+            return BuiltFunction(constant(item), Typer(example=item), domain_schema)
 
         return FunctionFactory(build_constant, Typer(example=item), f"{item}")
     else:
@@ -383,6 +446,7 @@ def wrap_func(func, return_type=None):
             if result:
                 def wrapped(val, att):
                     return func(val)
+                with_expr(wrapped, ("call", ("const", func), (("it",),), ()))
                 return wrapped, result()
     try:
         func_name = getattr(func, "__name__", getattr(func, "__class__").__name__)
@@ -413,12 +477,14 @@ def wrap_func(func, return_type=None):
             def wrap_init0(val, att):
                 return new_func()
 
+            with_expr(wrap_init0, ("call", ("const", new_func), (), ()))
             return wrap_init0, Typer(python_type=func)
         else:
 
             def wrap_init1(val, att):
                 return new_func(val)
 
+            with_expr(wrap_init1, ("call", ("const", new_func), (("it",),), ()))
             return wrap_init1, Typer(python_type=func)
     elif isinstance(func, FunctionType):
         spec = inspect.getfullargspec(func)
@@ -450,7 +516,7 @@ def wrap_func(func, return_type=None):
         def wrapper0(val, att):
             return func()
 
-        wrapper = wrapper0
+        wrapper = with_expr(wrapper0, ("call", ("const", func), (), ()))
     elif num_args == 2:
         if not spec.args[-1].startswith("att"):
             logger.error("expecting second parameter to be `att`", stack_depth=3)
@@ -469,6 +535,7 @@ def wrap_func(func, return_type=None):
         )
         wrapper = locals[func_name]
         setattr(wrapper, "original", func)
+        with_expr(wrapper, ("call", ("const", func), (("it",),), ()))
 
     # copy func name to wrapper for sensible debug output
     wrapper.__name__ = func_name
@@ -489,14 +556,14 @@ class TopFunctionFactory(FunctionFactory):
             typer = CallableTyper(return_type=value)
 
             def type_builder(domain_type, domain_schema) -> BuiltFunction:
-                return BuiltFunction(lambda v, a: value, typer, domain_schema)
+                return BuiltFunction(constant(value), typer, domain_schema)
 
             return FunctionFactory(type_builder, typer, f"{value}")
 
         typer = Typer(python_type=type(value))
 
         def value_builder(domain_type, domain_schema) -> BuiltFunction:
-            return BuiltFunction(lambda v, a: value, typer, domain_schema)
+            return BuiltFunction(constant(value), typer, domain_schema)
 
         return FunctionFactory(value_builder, typer, f"{value}")
 
@@ -508,6 +575,9 @@ def noop(v, a):
     return v
 
 
+with_expr(noop, ("it",))
+
+
 def top_builder(domain_type, domain_schema) -> BuiltFunction:
     return BuiltFunction(noop, domain_type, domain_schema)
 
@@ -6,7 +6,11 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
-import itertools
+import heapq
+import json
+import pickle
+from itertools import islice, chain
+from operator import itemgetter
 from typing import Any, Iterator, Dict, Tuple
 from zipfile import ZIP_STORED
 
@@ -16,22 +20,33 @@ from mo_future import zip_longest, first
 from mo_imports import expect, export
 from mo_logs import logger
 
-from mo_json import JxType, JX_INTEGER
+from mo_json import JxType, JX_INTEGER, scrub, value2json
 from mo_streams import ByteStream
+from mo_streams._bloom import BloomFilter
+from mo_streams._parallel import pool_iter, apply_function, prefetch_iter
+from mo_streams._spill import Partitions, SpillFile, partition_count, MAX_DEPTH
 from mo_streams._utils import (
     Reader,
     Writer,
     chunk_bytes,
     Stream,
+    terminator,
+    close_iter,
 )
+from mo_streams.aggregates import Aggregate
+from mo_streams.batch_stream import BatchStream
+from mo_streams.byte_stream import JSONL_BATCH_SIZE
+from mo_streams.csv_utils import write_csv, BATCH_SIZE as CSV_BATCH_SIZE
 from mo_streams.files import File_usingStream
-from mo_streams.function_factory import normalize
-from mo_streams.type_utils import Typer, LazyTyper, StreamTyper
+from mo_streams.function_factory import normalize, FunctionFactory, compiled
+from mo_streams.s3_utils import upload, PART_SIZE, WORKERS
+from mo_streams.type_utils import Typer, LazyTyper, StreamTyper, JxTyper
 
 DEBUG = False
 
 _get = object.__getattribute__
-stream = expect("stream")
+stream, AsyncObjectStream, offload = expect("stream", "AsyncObjectStream", "offload")
+
 
 ERROR = {}
 WARNING = {}
@@ -55,6 +70,9 @@ class ObjectStream(Stream):
     def __data__(self):
         return [f"...stream({self.typer})..."]
 
+    def close(self):
+        close_iter(self._iter)
+
     def __getattr__(self, item):
         type_ = getattr(self.typer, item)
 
@@ -97,12 +115,41 @@ class ObjectStream(Stream):
 
         return ObjectStream(read(), type_, self._schema)
 
-    def map(self, accessor):
+    def map(self, accessor, *, workers=None, executor="thread", ordered=True):
+        """
+        :param accessor: function, or FunctionFactory, to apply to each member
+        :param workers: number of pool workers, None to run in this thread
+        :param executor: "thread" or "process" (process requires a picklable, module-level function)
+        :param ordered: False to emit results as they complete
+        """
         if isinstance(accessor, str):
             type_ = getattr(self.typer, accessor)
             return ObjectStream(((getattr(v, accessor), a) for v, a in self._iter), type_, self._schema)
         fact = normalize(accessor, domain_type=self.typer)
-        acc_func, acc_type, acc_schema = fact.build(self.typer, self._schema)
+        acc_func, acc_type, acc_schema = compiled(fact.build(self.typer, self._schema))
+
+        if workers:
+            if executor == "process":
+                try:
+                    if isinstance(accessor, FunctionFactory):
+                        raise TypeError("FunctionFactory can not be pickled")
+                    pickle.dumps(accessor)
+                except Exception as cause:
+                    logger.error("process executor requires a module-level function", cause=cause)
+                func, args = apply_function, ((accessor, v, a) for v, a in self._iter)
+            else:
+                func, args = acc_func, self._iter
+
+            def read_parallel():
+                for args_, future in pool_iter(func, args, workers=workers, executor=executor, ordered=ordered):
+                    attach = args_[-1]
+                    try:
+                        yield future.result(), attach
+                    except Exception as cause:
+                        DEBUG and logger.warning("problem operating on {{value}}", value=args_[-2], cause=cause)
+                        yield None, attach
+
+            return ObjectStream(read_parallel(), acc_type, self._schema)
 
         def read():
             for value, attach in self._iter:
@@ -123,7 +170,7 @@ class ObjectStream(Stream):
 
     def filter(self, predicate):
         fact = normalize(predicate)
-        f, t, s = fact.build(self.typer, self._schema)
+        f, t, s = compiled(fact.build(self.typer, self._schema))
 
         def read():
             for v, a in self._iter:
@@ -137,9 +184,17 @@ class ObjectStream(Stream):
 
         return ObjectStream(read(), self.typer, self._schema)
 
+    def prefetch(self, size):
+        """
+        DRIVE THE UPSTREAM IN A BACKGROUND THREAD, UP TO size MEMBERS AHEAD, SO I/O AND COMPUTE OVERLAP
+        LAZY ARCHIVE MEMBERS STAY READABLE, EXCEPT FOR A TAR FROM A NON-SEEKABLE SOURCE, WHERE THE
+        LISTING CONSUMES THE CONTENT: READ THOSE MEMBERS BEFORE prefetch, NOT AFTER
+        """
+        return ObjectStream(prefetch_iter(self._iter, size), self.typer, self._schema)
+
     def attach(self, **kwargs):
         facts = {k: normalize(v) for k, v in kwargs.items()}
-        mapper = {k: f.build(self.typer, self._schema) for k, f in facts.items()}
+        mapper = {k: compiled(f.build(self.typer, self._schema)) for k, f in facts.items()}
         more_schema = JxType(**{k: f.return_type for k, f in mapper.items()})
 
         def read():
@@ -156,6 +211,25 @@ class ObjectStream(Stream):
 
         return ObjectStream(read(), self.typer, self._schema)
 
+    def batched(self, size=4096):
+        """
+        MOVE MEMBERS AND ATTACHMENTS IN BATCHES OF GIVEN SIZE
+        """
+
+        def read():
+            try:
+                while True:
+                    batch = list(islice(self._iter, size))
+                    if not batch:
+                        return
+                    values = [v for v, _ in batch]
+                    names = set().union(*(a for _, a in batch))
+                    yield values, {n: [a.get(n) for _, a in batch] for n in names}
+            finally:
+                close_iter(self._iter)
+
+        return BatchStream(read(), self.typer, self._schema)
+
     def enumerate(self):
         def read():
             for i, (v, a) in enumerate(self._iter):
@@ -171,29 +245,89 @@ class ObjectStream(Stream):
 
         return ObjectStream(read(), self.typer, self._schema)
 
-    def reverse(self):
+    def reverse(self, *, memory_limit=None):
+        """
+        :param memory_limit: maximum number of members held in memory, the rest are spilled to disk
+        """
+
         def read():
-            yield from reversed(list(self._iter))
+            if not memory_limit:
+                yield from reversed(list(self._iter))
+                return
+            runs = []
+            try:
+                while True:
+                    run = list(islice(self._iter, memory_limit))
+                    if not run:
+                        break
+                    file = SpillFile()
+                    file.write(run)
+                    runs.append(file)
+                while runs:
+                    for run in runs.pop().read():
+                        yield from reversed(run)
+            finally:
+                for file in runs:
+                    file.close()
 
         return ObjectStream(read(), self.typer, schema=self._schema)
 
-    def sort(self, *, key=None, reverse=0):
-        if key:
-            key = lambda t: key(t[0])
+    def sort(self, *, key=None, reverse=False, memory_limit=None):
+        """
+        STABLE SORT OF THE MEMBERS (ATTACHMENTS ARE NOT COMPARED)
+        :param key: function, or FunctionFactory, to get the value to sort by
+        :param reverse: True for descending order
+        :param memory_limit: maximum number of members held in memory, the rest are spilled to disk in sorted runs
+        """
+        if key is None:
+            key_function = lambda v, a: v
+        else:
+            key_function = compiled(normalize(key).build(self.typer, self._schema)).function
+        return SortedStream(self._iter, self.typer, self._schema, key_function, reverse, memory_limit)
 
-        def read():
-            yield from sorted(self._iter, key=key, reverse=reverse)
+    def top_k(self, count, *, key=None):
+        """
+        RETURN THE count LARGEST MEMBERS, LARGEST FIRST, WITHOUT SORTING THE WHOLE STREAM
+        """
+        return self.sort(key=key, reverse=True).limit(count)
 
-        return ObjectStream(read(), self.typer, self._schema)
+    def distinct(self, *, mode="exact", memory_limit=None, error_rate=0.001):
+        """
+        REMOVE DUPLICATE MEMBERS, KEEPING THE FIRST
+        :param mode: "exact" keeps every value in memory
+                     "bloom" keeps a bit array, and drops a unique value at error_rate
+                     "spill" keeps memory_limit values in memory, the rest are partitioned to disk
+        :param memory_limit: for "bloom", the expected number of distinct values (None to grow as needed);
+                             for "spill", the values kept in memory
+        :param error_rate: for "bloom", the chance a unique value is dropped
+        """
+        if mode == "exact":
+
+            def read():
+                acc = set()
+                for v, a in self._iter:
+                    if v in acc:
+                        continue
+                    acc.add(v)
+                    yield v, a
 
-    def distinct(self):
-        def read():
-            acc = set()
-            for v, a in self._iter:
-                if v in acc:
-                    continue
-                acc.add(v)
-                yield v, a
+        elif mode == "bloom":
+
+            def read():
+                acc = BloomFilter(memory_limit, error_rate)
+                for v, a in self._iter:
+                    if not acc.add(v):
+                        yield v, a
+
+        elif mode == "spill":
+            if not memory_limit:
+                logger.error("spill mode requires a memory_limit")
+
+            def read():
+                yield from _distinct_spill(self._iter, memory_limit)
+
+        else:
+            logger.error("expecting mode to be one of exact, bloom or spill, not {{mode|quote}}", mode=mode)
 
         return ObjectStream(read(), self.typer, self._schema)
 
@@ -228,6 +362,9 @@ class ObjectStream(Stream):
                     yield next(self._iter)
             except StopIteration:
                 pass
+            finally:
+                # DO NOT LEAVE THE UPSTREAM OPEN UNTIL IT IS GARBAGE COLLECTED
+                close_iter(self._iter)
 
         return ObjectStream(read(), self.typer, self._schema)
 
@@ -250,14 +387,26 @@ class ObjectStream(Stream):
             raw_group_function = groupor
 
         group_factory = normalize(raw_group_function, return_type=self.typer)
-        func = group_factory.build(self.typer, self._schema).function
+        func = compiled(group_factory.build(self.typer, self._schema)).function
         group_function = lambda pair: func(*pair)
         group_schema = JxType()  # NOT A REAL TYPE, WE ADD PYTHON TYPES ON THE LEAVES
         setattr(group_schema, name, group_factory.typer)
         sub_schema = self._schema | group_schema
 
         def read():
-            for group, rows in itertools.groupby(sorted(self._iter, key=group_function), group_function):
+            # HASH THE ROWS INTO GROUPS, ONLY THE GROUP KEYS ARE SORTED
+            groups = {}
+            for pair in self._iter:
+                groups.setdefault(group_function(pair), []).append(pair)
+            keys = list(groups)
+            try:
+                keys.sort()
+            except TypeError:
+                # UNORDERABLE KEYS ARE EMITTED IN THE ORDER FIRST SEEN
+                pass
+
+            for group in keys:
+                rows = groups.pop(group)
 
                 def read_rows():
                     for v, a in rows:
@@ -268,6 +417,84 @@ class ObjectStream(Stream):
 
         return ObjectStream(read(), StreamTyper(self.typer, sub_schema), group_schema)
 
+    def aggregate(self, groupor=None, *, name="group", memory_limit=None, **aggregates):
+        """
+        GROUP BY groupor EXPRESSION, IN ONE PASS, AND RETURN ONE dict PER GROUP WITH THE AGGREGATES
+            stream(words).aggregate(it, count=Count())  # {"group": "apple", "count": 3}, ...
+        MEMORY IS PROPORTIONAL TO THE NUMBER OF GROUPS, NOT THE NUMBER OF MEMBERS
+        :param groupor: function to extract group from row (None for one group)
+        :param name: name of the group property, also attached to each result
+        :param memory_limit: maximum number of groups held in memory, the rest are spilled to disk
+        :param aggregates: map from property name to Aggregate (see aggregates.py)
+        :return: stream of dicts, in the order the groups were first seen (unless spilled)
+        """
+        if groupor is None:
+            group_function = lambda v, a: None
+            group_type = Typer(python_type=type(None))
+        else:
+            if isinstance(groupor, str):
+                raw_group_function = lambda v: getattr(v, groupor)
+            else:
+                raw_group_function = groupor
+            group_factory = normalize(raw_group_function, return_type=self.typer)
+            group_function = compiled(group_factory.build(self.typer, self._schema)).function
+            group_type = group_factory.typer
+        for k, agg in aggregates.items():
+            if not isinstance(agg, Aggregate):
+                logger.error("expecting {{name|quote}} to be an Aggregate", name=k)
+        names = list(aggregates)
+        aggs = list(aggregates.values())
+        values = [
+            None if agg.value is None else compiled(normalize(agg.value).build(self.typer, self._schema)).function
+            for agg in aggs
+        ]
+        group_schema = JxType()
+        setattr(group_schema, name, group_type)
+
+        def value_of(func, v, a):
+            if func is None:
+                return v
+            try:
+                return func(v, a)
+            except Exception as cause:
+                DEBUG and logger.warning("problem operating on {{value}}", value=v, cause=cause)
+                return None
+
+        def read():
+            groups = {}
+            partitions = None
+            try:
+                for v, a in self._iter:
+                    key = group_function(v, a)
+                    states = groups.get(key)
+                    if states is None:
+                        if memory_limit and len(groups) >= memory_limit:
+                            # SPILL THE PARTIAL STATES, THEY ARE MERGED AT THE END
+                            partitions = partitions or Partitions()
+                            for k, s in groups.items():
+                                partitions.write(k, (k, s))
+                            groups.clear()
+                        states = groups[key] = [agg.start() for agg in aggs]
+                    for i, (agg, func) in enumerate(zip(aggs, values)):
+                        states[i] = agg.add(states[i], value_of(func, v, a))
+
+                if partitions:
+                    for k, s in groups.items():
+                        partitions.write(k, (k, s))
+                    groups.clear()
+                    for file in partitions.files:
+                        yield from _emit(_merge_spill(file.read(), aggs, memory_limit, file.count))
+                else:
+                    yield from _emit(groups.items())
+            finally:
+                partitions and partitions.close()
+
+        def _emit(pairs):
+            for key, states in pairs:
+                yield {name: key, **{n: agg.result(s) for n, agg, s in zip(names, aggs, states)}}, {name: key}
+
+        return ObjectStream(read(), Typer(python_type=dict), group_schema)
+
     ###########################################################################
     # TERMINATORS
     ###########################################################################
@@ -275,31 +502,45 @@ class ObjectStream(Stream):
     def materialize(self):
         return ObjectStream(list(self._iter), self.typer, self._schema)
 
+    @terminator
     def to_list(self):
         return list(v.to_list() if isinstance(v, Stream) else v for v, _ in self._iter)
 
+    def to_async(self):
+        """
+        RETURN AsyncObjectStream, THIS STREAM IS ITERATED IN A THREAD
+        """
+        return AsyncObjectStream(offload(self._iter), self.typer, self._schema)
+
+    @terminator
     def to_data(self):
         return list_to_data(list(v for v, _ in self._iter))
 
+    @terminator
     def count(self):
         return sum(1 for _ in self._iter)
 
+    @terminator
     def sum(self):
         return sum(v for v, _ in self._iter)
 
+    @terminator
     def first(self):
         for v, _ in self._iter:
             return v
 
+    @terminator
     def last(self):
         output = None
         for v, _ in self._iter:
             output = v
         return output
 
+    @terminator
     def join(self, separator):
         return separator.join(v for v, _ in self._iter)
 
+    @terminator
     def to_dict(self, key=None):
         """
         CONVERT STREAM TO dict
@@ -315,6 +556,39 @@ class ObjectStream(Stream):
 
         return {a[key]: v for v, a in self._iter}
 
+    def to_jsonl(self, *, batch_size=JSONL_BATCH_SIZE):
+        """
+        RETURN ByteStream OF JSON LINES, ENCODED batch_size MEMBERS AT A TIME
+        """
+
+        def read():
+            while True:
+                batch = list(islice(self._iter, batch_size))
+                if not batch:
+                    return
+                yield ("\n".join(to_json(v) for v, _ in batch) + "\n").encode("utf8")
+
+        return ByteStream(Reader(read()))
+
+    def to_csv(self, columns=None, *, batch_size=CSV_BATCH_SIZE, encoding="utf8", **fmtparams):
+        """
+        RETURN ByteStream OF CSV, ENCODED batch_size ROWS AT A TIME
+        :param columns: list of column names (default is the properties of the schema, or of the first member)
+        :param fmtparams: passed to csv.writer (like delimiter)
+        """
+        values = (v for v, _ in self._iter)
+        if columns is None:
+            if isinstance(self.typer, JxTyper):
+                columns = list(vars(self.typer.type_))
+            else:
+                example = next(values, None)
+                if not hasattr(example, "keys"):
+                    logger.error("expecting columns, or a stream of dicts, not {{type}}", type=type(example).__name__)
+                columns = list(example.keys())
+                values = chain([example], values)
+
+        return ByteStream(Reader(write_csv(values, columns, batch_size=batch_size, encoding=encoding, **fmtparams)))
+
     def to_zip(
         self, compression=ZIP_STORED, allowZip64=True, compresslevel=None,
     ):
@@ -339,13 +613,170 @@ class ObjectStream(Stream):
                     with archive.open(info, mode=mode) as target:
                         for chunk in chunk_bytes(file.bytes()):
                             target.write(chunk)
-                            yield writer.read()
+                            yield from writer.drain()
 
-            yield writer.read()
+            yield from writer.drain()
             writer.close()
 
         return ByteStream(Reader(read()))
 
+    @terminator
+    def to_s3(self, *, bucket, prefix="", part_size=PART_SIZE, workers=WORKERS, client=None):
+        """
+        UPLOAD EACH File TO bucket, workers FILES AT A TIME, RETURN THE LIST OF KEYS
+        EACH FILE IS READ ON A WORKER THREAD, SO FILES MUST BE INDEPENDENTLY READABLE (NOT MEMBERS OF THE SAME tar)
+        :param prefix: prepended to the rel_path of each File to make the key
+        :param part_size: bytes per multipart part
+        :param client: boto3 s3 client (default is a shared, pooled, client)
+        """
+        type_ = self.typer.python_type
+        if type_ not in (File, File_usingStream):
+            logger.error("expecting stream of Files")
+
+        params = {"bucket": bucket, "part_size": part_size, "workers": 1, "client": client}
+        uploads = ((file.bytes().reader, {**params, "key": prefix + file.rel_path}) for file, _ in self._iter)
+        keys = []
+        for (_, params), future in pool_iter(_upload, uploads, workers=workers or 1):
+            future.result()
+            keys.append(params["key"])
+        return keys
+
+
+def _distinct_spill(pairs, memory_limit, size=None, depth=0):
+    """
+    RETURN GENERATOR OF THE FIRST (v, a) FOR EACH v, WITH AT MOST memory_limit VALUES IN MEMORY
+    UNSEEN VALUES PAST THAT ARE PARTITIONED TO DISK, AND EACH PARTITION IS DONE THE SAME WAY
+    :param size: number of pairs, if known, to choose the number of partitions
+    """
+    acc = set()
+    partitions = None
+    try:
+        for v, a in pairs:
+            if v in acc:
+                continue
+            if len(acc) < memory_limit or depth >= MAX_DEPTH:
+                acc.add(v)
+                yield v, a
+            else:
+                # NOT SEEN YET, BUT NO ROOM: DECIDE LATER
+                partitions = partitions or Partitions(partition_count(size, memory_limit), depth)
+                partitions.write(v, (v, a))
+        acc.clear()
+        if partitions:
+            for file in partitions.files:
+                yield from _distinct_spill(file.read(), memory_limit, file.count, depth + 1)
+    finally:
+        partitions and partitions.close()
+
+
+def _merge_spill(pairs, aggs, memory_limit, size=None, depth=1):
+    """
+    RETURN GENERATOR OF (key, states), MERGING THE PARTIAL states OF EQUAL keys
+    AT MOST memory_limit keys ARE MERGED IN MEMORY, THE OTHERS ARE PARTITIONED TO DISK,
+    AND EACH PARTITION IS DONE THE SAME WAY
+    """
+    merged = {}
+    partitions = None
+    try:
+        for k, s in pairs:
+            states = merged.get(k)
+            if states is not None:
+                merged[k] = [agg.merge(x, y) for agg, x, y in zip(aggs, states, s)]
+            elif len(merged) < memory_limit or depth >= MAX_DEPTH:
+                merged[k] = s
+            else:
+                partitions = partitions or Partitions(partition_count(size, memory_limit), depth)
+                partitions.write(k, (k, s))
+        yield from merged.items()
+        merged.clear()
+        if partitions:
+            for file in partitions.files:
+                yield from _merge_spill(file.read(), aggs, memory_limit, file.count, depth + 1)
+    finally:
+        partitions and partitions.close()
+
+
+def _upload(reader, params):
+    upload(reader, **params)
+
+
+_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, allow_nan=False, default=scrub).encode
+
+
+def to_json(value):
+    """
+    FAST JSON ENCODING, WITH value2json FOR WHAT THE STANDARD ENCODER CAN NOT DO (LIKE NaN)
+    BOTH DROP null PROPERTIES, SO RECORDS HAVE THE SAME SHAPE WHICHEVER IS USED
+    """
+    try:
+        return _encode(_prune(value))
+    except (TypeError, ValueError):
+        return value2json(value)
+
+
+def _prune(value):
+    # OTHER TYPES (LIKE Data) ARE SENT TO scrub BY THE ENCODER
+    if isinstance(value, dict):
+        return {k: _prune(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_prune(v) for v in value]
+    return value
+
+
+class SortedStream(ObjectStream):
+    """
+    A SORTED ObjectStream, SO limit() CAN BE DONE WITH A HEAP
+    """
+
+    def __init__(self, values, datatype, schema, key_function, reverse, memory_limit):
+        self._source = values
+        self._key_function = key_function
+        self._reverse = reverse
+        self._memory_limit = memory_limit
+        ObjectStream.__init__(self, self._sorted(), datatype, schema)
+
+    def _sorted(self):
+        key_function = lambda pair: self._key_function(*pair)
+        if not self._memory_limit:
+            yield from sorted(self._source, key=key_function, reverse=self._reverse)
+            return
+
+        runs = []
+        try:
+            while True:
+                run = sorted(islice(self._source, self._memory_limit), key=key_function, reverse=self._reverse)
+                if not run:
+                    break
+                if not runs and len(run) < self._memory_limit:
+                    # FITS IN MEMORY
+                    yield from run
+                    return
+                file = SpillFile()
+                file.extend((key_function(pair), pair) for pair in run)
+                runs.append(file)
+                del run
+
+            # heapq.merge IS STABLE: EQUAL KEYS COME FROM THE EARLIER RUN FIRST
+            for _, pair in heapq.merge(*(r.read() for r in runs), key=itemgetter(0), reverse=self._reverse):
+                yield pair
+        finally:
+            for file in runs:
+                file.close()
+
+    def close(self):
+        try:
+            ObjectStream.close(self)
+        finally:
+            close_iter(self._source)
+
+    def limit(self, count):
+        def read():
+            select = heapq.nlargest if self._reverse else heapq.nsmallest
+            yield from select(count, self._source, key=lambda pair: self._key_function(*pair))
+
+        return ObjectStream(read(), self.typer, self._schema)
+
 
 export("mo_streams.byte_stream", ObjectStream)
+export("mo_streams.batch_stream", ObjectStream)
 export("mo_streams.type_utils", ObjectStream)
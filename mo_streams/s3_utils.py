@@ -0,0 +1,156 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from threading import Lock
+
+from mo_logs import logger
+
+from mo_streams._parallel import pool_iter
+
+PART_SIZE = 8 * 1024 * 1024
+WORKERS = 8
+PREFETCH = 16  # OBJECTS DOWNLOADED AHEAD OF THE CONSUMER
+POOL_SIZE = 32  # HTTP CONNECTIONS KEPT OPEN BY THE SHARED CLIENT
+
+_client = None
+_client_lock = Lock()
+
+
+def get_client():
+    """
+    RETURN THE SHARED s3 CLIENT (boto3 CLIENTS ARE THREAD SAFE), SO CONNECTIONS ARE REUSED
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            from botocore.config import Config
+
+            _client = boto3.session.Session().client("s3", config=Config(max_pool_connections=POOL_SIZE))
+        return _client
+
+
+def transfer_config(part_size=PART_SIZE, workers=WORKERS):
+    """
+    :param part_size: bytes per multipart part (at least 5MB, except the last)
+    :param workers: number of parts uploaded at once (None or 1 for sequential)
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    workers = workers or 1
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=workers,
+        use_threads=workers > 1,
+    )
+
+
+def upload(reader, *, bucket, key, part_size=PART_SIZE, workers=WORKERS, client=None):
+    """
+    UPLOAD THE FILE-LIKE reader, IN PARTS OF part_size, workers PARTS AT A TIME
+    """
+    try:
+        (client or get_client()).upload_fileobj(reader, bucket, key, Config=transfer_config(part_size, workers))
+    except Exception as cause:
+        logger.error("problem with s3 upload to {{bucket}}/{{key}}", bucket=bucket, key=key, cause=cause)
+
+
+def download_chunks(*, bucket, key, part_size=PART_SIZE, workers=WORKERS, prefetch=None, client=None):
+    """
+    RETURN GENERATOR OF THE OBJECT CONTENT, IN ORDER
+    WITH workers, THE FIRST part_size BYTES ARE FETCHED WITH ONE GET, WHICH ALSO GIVES THE SIZE, SO A SMALL OBJECT
+    NEEDS NO MORE REQUESTS; THE OTHER PARTS ARE FETCHED WITH RANGED GETs IN PARALLEL, AT MOST prefetch PARTS AHEAD
+    :param prefetch: maximum parts held in memory (default 2*workers)
+    """
+    client = client or get_client()
+    if not workers or workers <= 1:
+        return _body_chunks(client, bucket, key, part_size)
+
+    def read():
+        data, size, etag = _first_part(client, bucket, key, part_size)
+        if data:
+            yield data
+        if size <= part_size:
+            return
+        # IfMatch ENSURES ALL PARTS COME FROM THE SAME VERSION OF THE OBJECT
+        ranges = (
+            (client, bucket, key, start, min(start + part_size, size) - 1, etag)
+            for start in range(part_size, size, part_size)
+        )
+        for _, future in pool_iter(_get_range, ranges, workers=workers, max_pending=prefetch):
+            yield future.result()
+
+    return read()
+
+
+def list_objects(*, bucket, prefix="", client=None):
+    """
+    RETURN GENERATOR OF THE LISTED OBJECTS (dicts WITH Key, Size, ETag), ONE PAGE REQUESTED AT A TIME
+    """
+    paginator = (client or get_client()).get_paginator("list_objects_v2")
+    try:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            yield from page.get("Contents", [])
+    except Exception as cause:
+        logger.error("problem listing s3 {{bucket}}/{{prefix}}", bucket=bucket, prefix=prefix, cause=cause)
+
+
+def get_bytes(bucket, key, etag, client):
+    """
+    RETURN THE WHOLE CONTENT OF THE OBJECT
+    """
+    try:
+        return client.get_object(Bucket=bucket, Key=key, IfMatch=etag)["Body"].read()
+    except Exception as cause:
+        logger.error("problem with s3 download of {{bucket}}/{{key}}", bucket=bucket, key=key, cause=cause)
+
+
+def _first_part(client, bucket, key, part_size):
+    """
+    RETURN (data, size, etag), data IS THE FIRST part_size BYTES, size IS OF THE WHOLE OBJECT
+    """
+    try:
+        response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{part_size - 1}")
+    except Exception as cause:
+        if getattr(cause, "response", {}).get("Error", {}).get("Code") == "InvalidRange":
+            # NO RANGE OF AN EMPTY OBJECT
+            return b"", 0, None
+        logger.error("problem with s3 download of {{bucket}}/{{key}}", bucket=bucket, key=key, cause=cause)
+    content_range = response.get("ContentRange")
+    size = int(content_range.split("/")[-1]) if content_range else response["ContentLength"]
+    return response["Body"].read(), size, response["ETag"]
+
+
+def _get_range(client, bucket, key, start, end, etag):
+    try:
+        return client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)["Body"].read()
+    except Exception as cause:
+        logger.error(
+            "problem with s3 download of {{bucket}}/{{key}} (bytes {{start}}-{{end}})",
+            bucket=bucket,
+            key=key,
+            start=start,
+            end=end,
+            cause=cause,
+        )
+
+
+def _body_chunks(client, bucket, key, size):
+    try:
+        body = client.get_object(Bucket=bucket, Key=key)["Body"]
+    except Exception as cause:
+        logger.error("problem with s3 download of {{bucket}}/{{key}}", bucket=bucket, key=key, cause=cause)
+    try:
+        while True:
+            data = body.read(size)
+            if not data:
+                return
+            yield data
+    finally:
+        body.close()
@@ -6,16 +6,18 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
-import csv
 import sys
 
-from mo_imports import export
+from mo_imports import export, expect
 
 from mo_json import JxType, JX_TEXT
-from mo_streams._utils import Reader, Stream
+from mo_streams._utils import Reader, Stream, split_lines, terminator, close_iter
 from mo_streams.byte_stream import ByteStream
+from mo_streams.csv_utils import read_csv, SAMPLE_SIZE, BATCH_SIZE
 from mo_streams.object_stream import ObjectStream
-from mo_streams.type_utils import Typer, JxTyper
+from mo_streams.type_utils import Typer, LiveJxTyper
+
+AsyncStringStream, offload = expect("AsyncStringStream", "offload")
 
 line_terminator = "lineterminator" if sys.version_info[0] == 3 and sys.version_info[1] >= 8 else "line_terminator"
 
@@ -24,6 +26,9 @@ class StringStream(Stream):
     def __init__(self, chunks):
         self._chunks = chunks
 
+    def close(self):
+        close_iter(self._chunks)
+
     def __getattr__(self, item):
         def read():
             for v in self._chunks:
@@ -34,44 +39,43 @@ class StringStream(Stream):
     def utf8(self) -> ByteStream:
         return ByteStream(Reader((c.encode("utf8") for c in self._chunks)))
 
-    def csv(self):
-        lines_gen = (r for r, _ in self.lines()._iter)
-        reader = csv.DictReader(lines_gen)
-        column_names = reader.fieldnames
-        jx_type = JxType(**{n: str for n in column_names})
-        rec0 = next(reader)
-
-        def read():
-            yield rec0, {}
-            for rec in reader:
-                yield rec, {}
-
-        return ObjectStream(read(), JxTyper(jx_type), JxType())
+    def csv(self, *, infer_types=False, output="dict", sample_size=SAMPLE_SIZE, batch_size=BATCH_SIZE, **fmtparams):
+        """
+        RETURN STREAM OF CSV ROWS, FIRST ROW IS THE HEADER (SEE csv_utils.read_csv)
+        """
+        names, types, rows = read_csv(
+            self._chunks,
+            infer_types=infer_types,
+            output=output,
+            sample_size=sample_size,
+            batch_size=batch_size,
+            **fmtparams,
+        )
+        if output == "dict":
+            # types CHANGES WHEN A COLUMN FALLS BACK TO str
+            typer = LiveJxTyper(lambda: JxType(**types))
+        elif output == "tuple":
+            typer = Typer(python_type=tuple)
+        else:
+            typer = Typer(python_type=dict)
+        return ObjectStream(((row, {}) for row in rows), typer, JxType())
 
     def lines(self):
         def read():
-            line = ""
-            end = -1
-            try:
-                while True:
-                    while end == -1:
-                        content = next(self._chunks)
-                        line += content
-                        end = line.find("\n")
-
-                    while end != -1:
-                        yield line[:end], {}
-                        end += 1
-                        line = line[end:]
-                        end = line.find("\n")
-            except StopIteration:
-                if line:
-                    yield line, {}
+            for line in split_lines(self._chunks):
+                yield line, {}
 
         return ObjectStream(read(), Typer(python_type=str), JxType())
 
+    @terminator
     def to_str(self) -> str:
         return "".join(self._chunks)
 
+    def to_async(self):
+        """
+        RETURN AsyncStringStream, THIS STREAM IS READ IN A THREAD
+        """
+        return AsyncStringStream(offload(iter(self._chunks), batch_size=16))
+
 
 export("mo_streams.byte_stream", StringStream)
@@ -0,0 +1,150 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+# RANDOM ACCESS TO TAR, AND tar.zst, MEMBERS USING AN INDEX
+#
+# THE INDEX IS A JSON-ABLE dict:
+#     members - LIST OF {name, offset, size, file}, offset IS WHERE THE CONTENT
+#               STARTS IN THE (UNCOMPRESSED) TAR
+#     frames  - FOR tar.zst, LIST OF [offset, size, tar_offset, tar_size] FOR EACH
+#               zstd FRAME; null FOR PLAIN TAR
+#
+import json
+import tarfile
+from bisect import bisect_right
+
+from mo_files import File
+from mo_logs import logger
+
+from mo_streams._utils import Reader, SharedReader, chunk_bytes
+from mo_streams.compression import sniff
+from mo_streams.zst_utils import zst_frame_table, new_decompressor
+
+INDEX_VERSION = 1
+READ_SIZE = 64 * 1024
+
+
+def build_index(reader):
+    """
+    READ THE WHOLE (PLAIN OR zst) TAR, RETURN ITS INDEX
+    """
+    method, reader = sniff(reader)
+    if method == "from_zst":
+        if not reader.seekable():
+            logger.error("indexing a tar.zst requires a seekable source, like a file")
+        frames = [[offset, size] for offset, size in zst_frame_table(reader)]
+        tar = Reader(_decompress_frames(SharedReader(reader), frames))
+    elif method:
+        logger.error("can only index plain tar, or tar.zst, not {{method}}", method=method)
+    else:
+        frames = None
+        tar = reader
+
+    archive = tarfile.open(fileobj=tar, mode="r|")
+    members = []
+    for info in archive:
+        members.append({"name": info.name, "offset": info.offset_data, "size": info.size, "file": info.isfile()})
+        # STREAM MODE KEEPS EVERY TarInfo, WE HAVE OUR OWN LIST
+        archive.members = []
+    if frames is not None:
+        # DRAIN THE PADDING, SO ALL FRAME SIZES ARE RECORDED
+        for _ in chunk_bytes(tar):
+            pass
+    return {"version": INDEX_VERSION, "members": members, "frames": frames}
+
+
+def load_index(index):
+    """
+    :param index: the index dict, or the File (or path) of the JSON sidecar
+    """
+    if isinstance(index, dict):
+        result = index
+    else:
+        result = json.loads(File(index).read_bytes().decode("utf8"))
+    if result.get("version") != INDEX_VERSION:
+        logger.error(
+            "expecting tar index version {{expected}}, not {{version}}",
+            expected=INDEX_VERSION,
+            version=result.get("version"),
+        )
+    return result
+
+
+def index_to_bytes(index):
+    return json.dumps(index, separators=(",", ":")).encode("utf8")
+
+
+def member_chunks(reader, index, member):
+    """
+    RETURN GENERATOR OF THE CONTENT OF member, READ FROM THE (RAW) SharedReader
+    """
+    frames = index["frames"]
+    if frames is None:
+        return range_chunks(reader, member["offset"], member["size"])
+    return _zst_range(reader, frames, member["offset"], member["size"])
+
+
+def _decompress_frames(reader, frames):
+    """
+    DECOMPRESS EACH FRAME ON ITS OWN, FILLING IN THE POSITION AND SIZE OF EACH IN THE TAR
+    """
+    tar_offset = 0
+    for frame in frames:
+        offset, size = frame
+        tar_size = 0
+        for chunk in _frame_chunks(reader, offset, size):
+            tar_size += len(chunk)
+            yield chunk
+        frame.extend([tar_offset, tar_size])
+        tar_offset += tar_size
+
+
+def _zst_range(reader, frames, offset, size):
+    """
+    RETURN GENERATOR OF size BYTES FROM offset IN THE TAR, DECOMPRESSING ONLY THE FRAMES THAT COVER IT
+    """
+    starts = [f[2] for f in frames]
+    first = max(0, bisect_right(starts, offset) - 1)
+    skip = offset - frames[first][2]
+    remaining = size
+    for frame_offset, frame_size, _, _ in frames[first:]:
+        if not remaining:
+            return
+        for chunk in _frame_chunks(reader, frame_offset, frame_size):
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            if len(chunk) >= remaining:
+                yield chunk[:remaining]
+                return
+            remaining -= len(chunk)
+            yield chunk
+    if remaining:
+        logger.error("tar.zst ended before the end of the member")
+
+
+def _frame_chunks(reader, offset, size):
+    frame = new_decompressor().stream_reader(Reader(range_chunks(reader, offset, size)), read_across_frames=False)
+    yield from chunk_bytes(frame, READ_SIZE)
+
+
+def range_chunks(reader, offset, size):
+    """
+    RETURN GENERATOR OF size BYTES FROM offset OF THE SharedReader, SO OTHER THREADS CAN SHARE reader
+    """
+    position = offset
+    end = offset + size
+    while position < end:
+        data = reader.read_at(position, min(READ_SIZE, end - position))
+        if not data:
+            logger.error("archive ended before the end of the member")
+        position += len(data)
+        yield data
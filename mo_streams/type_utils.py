@@ -11,7 +11,7 @@ import inspect
 from mo_imports import expect, export
 from mo_logs import logger
 
-from mo_json import JxType, JX_TEXT, array_of, JX_IS_NULL
+from mo_json import JxType, JX_TEXT, array_of, JX_IS_NULL, value_to_jx_type
 from mo_streams._utils import arg_spec
 
 parse, ANNOTATIONS, ObjectStream = expect("parse", "ANNOTATIONS", "ObjectStream")
@@ -91,6 +91,17 @@ class Typer:
             return f"Typer(class={self.python_type})"
 
 
+def infer_jx_type(values):
+    """
+    RETURN THE JxType THAT COVERS ALL values
+    """
+    output = None
+    for v in values:
+        type_ = value_to_jx_type(v)
+        output = type_ if output is None else output | type_
+    return JX_IS_NULL if output is None else output
+
+
 class JxTyper(Typer):
     """
     represent Data schema
@@ -122,6 +133,22 @@ class JxTyper(Typer):
     __repr__ = __str__
 
 
+class LiveJxTyper(JxTyper):
+    """
+    JxTyper OF A TYPE THAT IS NOT KNOWN WHEN THE STREAM IS MADE, OR CHANGES AS THE STREAM IS READ
+    """
+
+    def __init__(self, get_type):
+        """
+        :param get_type: function that returns the JxType, called each time the type is needed
+        """
+        self._get_type = get_type
+
+    @property
+    def type_(self):
+        return self._get_type()
+
+
 class StreamTyper(Typer):
     """
     AN ObjectStream HAS A TYPE TOO
@@ -291,3 +318,5 @@ class LazyTyper(Typer):
 
 export("mo_streams.type_parser", Typer)
 export("mo_streams.byte_stream", Typer)
+export("mo_streams.byte_stream", LiveJxTyper)
+export("mo_streams.byte_stream", infer_jx_type)
@@ -0,0 +1,181 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+# ZSTANDARD FRAME HANDLING, SEE https://www.rfc-editor.org/rfc/rfc8878
+#
+from mo_logs import logger
+
+ZSTD_MAGIC = 0xFD2FB528
+SKIPPABLE_MAGIC = 0x184D2A50  # LOW 4 BITS ARE FREE
+FCS_SIZES = (0, 2, 4, 8)
+DICT_ID_SIZES = (0, 1, 2, 4)
+MAX_FRAME_SIZE = 8 * 1024 * 1024  # LARGER (COMPRESSED) FRAMES ARE NOT DECOMPRESSED IN PARALLEL
+
+
+def zst_frames(reader):
+    """
+    RETURN GENERATOR OF COMPLETE zstd FRAMES (bytes), READ FROM THE FILE-LIKE reader
+    ONLY THE FRAME AND BLOCK HEADERS ARE PARSED, NOTHING IS DECOMPRESSED
+    SKIPPABLE FRAMES ARE DROPPED
+    """
+    while True:
+        frame, _ = next_frame(reader)
+        if not frame:
+            return
+        yield frame
+
+
+def next_frame(reader, max_size=None):
+    """
+    RETURN (frame, complete) FOR THE NEXT zstd FRAME IN reader, (b"", True) AT THE END
+    IF THE FRAME IS LARGER THAN max_size, READING STOPS, AND ITS FIRST BYTES ARE RETURNED WITH complete=False
+    """
+    while True:
+        magic = _read_exact(reader, 4, eof_ok=True)
+        if not magic:
+            return b"", True
+        number = int.from_bytes(magic, "little")
+        if number & 0xFFFFFFF0 == SKIPPABLE_MAGIC:
+            size = int.from_bytes(_read_exact(reader, 4), "little")
+            _read_exact(reader, size)
+            continue
+        if number != ZSTD_MAGIC:
+            logger.error("not a zstd frame (magic={{magic}})", magic=hex(number))
+        break
+
+    parts = [magic]
+    descriptor = _read_exact(reader, 1)
+    parts.append(descriptor)
+    flags = descriptor[0]
+    parts.append(_read_exact(reader, _header_size(flags)))
+    size = sum(len(p) for p in parts)
+
+    while True:
+        if max_size and size > max_size:
+            return b"".join(parts), False
+        block_header = _read_exact(reader, 3)
+        parts.append(block_header)
+        header = int.from_bytes(block_header, "little")
+        block_type = (header >> 1) & 0x3
+        if block_type == 3:
+            logger.error("reserved zstd block type")
+        block = _read_exact(reader, 1 if block_type == 1 else header >> 3)
+        parts.append(block)
+        size += 3 + len(block)
+        if header & 1:
+            break
+    if flags & 0x4:
+        parts.append(_read_exact(reader, 4))
+    return b"".join(parts), True
+
+
+def zst_frame_table(reader):
+    """
+    RETURN LIST OF (offset, size) OF EACH zstd FRAME IN THE SEEKABLE reader
+    BLOCK CONTENT IS SEEKED OVER, NOT READ; SKIPPABLE FRAMES ARE DROPPED
+    """
+    table = []
+    start = reader.tell()
+    while True:
+        offset = reader.tell()
+        magic = _read_exact(reader, 4, eof_ok=True)
+        if not magic:
+            reader.seek(start)
+            return table
+        number = int.from_bytes(magic, "little")
+        if number & 0xFFFFFFF0 == SKIPPABLE_MAGIC:
+            size = int.from_bytes(_read_exact(reader, 4), "little")
+            reader.seek(size, 1)
+            continue
+        if number != ZSTD_MAGIC:
+            logger.error("not a zstd frame (magic={{magic}})", magic=hex(number))
+
+        flags = _read_exact(reader, 1)[0]
+        reader.seek(_header_size(flags), 1)
+        while True:
+            header = int.from_bytes(_read_exact(reader, 3), "little")
+            block_type = (header >> 1) & 0x3
+            if block_type == 3:
+                logger.error("reserved zstd block type")
+            reader.seek(1 if block_type == 1 else header >> 3, 1)
+            if header & 1:
+                break
+        if flags & 0x4:
+            reader.seek(4, 1)
+        table.append((offset, reader.tell() - offset))
+
+
+def compress_frame(data, params):
+    """
+    RETURN ONE COMPLETE FRAME (RUN IN A POOL, SO EACH CALL HAS ITS OWN COMPRESSOR)
+    """
+    return new_compressor(**params).compress(data)
+
+
+def decompress_frame(frame, params):
+    """
+    RETURN THE CONTENT OF ONE FRAME (RUN IN A POOL, SO EACH CALL HAS ITS OWN DECOMPRESSOR)
+    """
+    return new_decompressor(**params).decompressobj().decompress(frame)
+
+
+def new_compressor(level=3, threads=0, long_distance=False, window_log=None, dictionary=None):
+    """
+    :param level: compression level (1 to 22, negative for faster)
+    :param threads: number of threads zstd uses to compress (0 for none, -1 for one per core)
+    :param long_distance: True to enable long distance matching
+    :param window_log: log2 of the window size (larger finds more distant matches, uses more memory)
+    :param dictionary: bytes, or zstandard.ZstdCompressionDict, to compress with
+    """
+    from zstandard import ZstdCompressor, ZstdCompressionParameters
+
+    params = ZstdCompressionParameters.from_level(
+        level, threads=threads, enable_ldm=long_distance, **({"window_log": window_log} if window_log else {})
+    )
+    return ZstdCompressor(compression_params=params, dict_data=as_dictionary(dictionary))
+
+
+def new_decompressor(dictionary=None, max_window_size=0):
+    """
+    :param dictionary: bytes, or zstandard.ZstdCompressionDict, used to compress
+    :param max_window_size: largest window allowed (0 for the zstd default of 128MB)
+    """
+    from zstandard import ZstdDecompressor
+
+    return ZstdDecompressor(dict_data=as_dictionary(dictionary), max_window_size=max_window_size)
+
+
+def as_dictionary(dictionary):
+    if dictionary is None or not isinstance(dictionary, (bytes, bytearray, memoryview)):
+        return dictionary
+    from zstandard import ZstdCompressionDict
+
+    return ZstdCompressionDict(bytes(dictionary))
+
+
+def _header_size(flags):
+    """
+    RETURN SIZE OF THE FRAME HEADER THAT FOLLOWS THE DESCRIPTOR BYTE
+    """
+    single_segment = flags & 0x20
+    fcs_size = FCS_SIZES[flags >> 6] or (1 if single_segment else 0)
+    return (0 if single_segment else 1) + DICT_ID_SIZES[flags & 0x3] + fcs_size
+
+
+def _read_exact(reader, size, eof_ok=False):
+    parts = []
+    remaining = size
+    while remaining:
+        data = reader.read(remaining)
+        if not data:
+            if eof_ok and remaining == size:
+                return b""
+            logger.error("zstd stream ended in the middle of a frame")
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts) if len(parts) != 1 else parts[0]
@@ -0,0 +1,42 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+THROUGHPUT OF ByteStream.utf8() FOR VARIOUS CHUNK SIZES
+
+    python tests/benchmark_decode.py [total_megabytes]
+"""
+import sys
+from io import BytesIO
+from time import perf_counter
+
+from mo_streams import ByteStream
+
+KB = 1024
+MB = 1024 * KB
+TEXT = "café ☃ plain ascii text, and more of it\n".encode("utf8")
+
+
+def bench(data, chunk_size):
+    start = perf_counter()
+    for _ in ByteStream(BytesIO(data)).utf8(chunk_size=chunk_size)._chunks:
+        pass
+    return perf_counter() - start
+
+
+def main():
+    total = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 256 * MB
+    data = TEXT * (total // len(TEXT))
+    print(f"decoding {len(data) // MB}MB of utf8")
+    for name, size in (("4KB", 4 * KB), ("64KB", 64 * KB), ("1MB", MB), ("16MB", 16 * MB)):
+        duration = bench(data, size)
+        print(f"utf8({name:>4}): {len(data) / MB / duration:9.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+THROUGHPUT OF Reader.read() AND Reader.readinto() FOR VARIOUS READ SIZES
+
+    python tests/benchmark_reader.py [total_megabytes]
+"""
+import sys
+from time import perf_counter
+
+from mo_streams._utils import Reader
+
+KB = 1024
+MB = 1024 * KB
+CHUNK = bytes(range(256)) * (256 * KB // 256)  # GENERATOR EMITS 256KB CHUNKS
+
+
+def generate(total):
+    remaining = total
+    while remaining > 0:
+        yield CHUNK if remaining >= len(CHUNK) else CHUNK[:remaining]
+        remaining -= len(CHUNK)
+
+
+def bench_read(total, read_size):
+    reader = Reader(generate(total))
+    start = perf_counter()
+    while reader.read(read_size):
+        pass
+    return perf_counter() - start
+
+
+def bench_readinto(total, read_size):
+    reader = Reader(generate(total))
+    buffer = bytearray(read_size)
+    start = perf_counter()
+    while reader.readinto(buffer):
+        pass
+    return perf_counter() - start
+
+
+def main():
+    total = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 1024 * MB
+    print(f"reading {total // MB}MB from a generator of {len(CHUNK) // KB}KB chunks")
+    for name, size in (("1KB", KB), ("64KB", 64 * KB), ("1MB", MB)):
+        for method, bench in (("read", bench_read), ("readinto", bench_readinto)):
+            duration = bench(total, size)
+            print(f"{method:>8}({name:>4}): {total / MB / duration:9.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
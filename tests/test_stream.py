@@ -7,6 +7,9 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from threading import Thread
 from unittest import TestCase, skipIf, skip
 
 import boto3
@@ -19,11 +22,31 @@ from mo_threads import start_main_thread, stop_main_thread
 from mo_times import Date, YEAR
 from moto import mock_aws
 
-from mo_json import json2value
-from mo_streams import stream, it, ANNOTATIONS, Typer, EmptyStream, from_s3
-from mo_streams._utils import Writer
+from mo_json import json2value, JxType, JX_INTEGER, JX_TEXT
+from mo_streams import (
+    ByteStream,
+    StringStream,
+    stream,
+    it,
+    ANNOTATIONS,
+    Typer,
+    EmptyStream,
+    from_s3,
+    from_s3_prefix,
+    Count,
+    Max,
+    Sum,
+    Mean,
+    First,
+    Reduce,
+    Min,
+    S3Object,
+)
+from mo_streams._utils import Writer, Reader, chunk_bytes, MmapReader
 from mo_streams.files import File_usingStream
+from mo_streams.function_factory import normalize, compiled
 from mo_streams.string_stream import line_terminator
+from mo_streams.zst_utils import zst_frames
 
 IS_CI = bool(os.environ.get("CI"))
 
@@ -91,6 +114,460 @@ class TestStream(TestCase):
         content = file.content().rel_path.to_list()
         self.assertEqual(content, ["LICENSE", "README.md"])
 
+    def test_from_zip_parallel(self):
+        data = File("tests/resources/example.zip").read_bytes()
+
+        def read(f):
+            return f.rel_path, f.content().utf8().to_str()
+
+        expected = ByteStream(Reader(iter([data]))).from_zip().map(read).to_list()
+        # NON-SEEKABLE SOURCE IS SPILLED, MEMBERS ARE DECOMPRESSED ON THE POOL
+        source = Reader(data[i : i + 1000] for i in range(0, len(data), 1000))
+        result = ByteStream(source).from_zip(workers=2, prefetch=1).map(read).to_list()
+        self.assertEqual(result, expected)
+        self.assertEqual([name for name, _ in result], ["LICENSE", "README.md"])
+
+    def test_reader_across_chunks(self):
+        data = bytes(range(256)) * 40
+        reader = Reader(data[i : i + 100] for i in range(0, len(data), 100))
+        self.assertEqual(reader.read(3), data[:3])
+        self.assertEqual(reader.read(250), data[3:253])
+        buffer = bytearray(1000)
+        self.assertEqual(reader.readinto(buffer), 1000)
+        self.assertEqual(bytes(buffer), data[253:1253])
+        reader.seek(2000)
+        self.assertEqual(reader.tell(), 2000)
+        self.assertEqual(b"".join(chunk_bytes(reader)), data[2000:])
+        self.assertEqual(reader.read(10), b"")
+
+    def test_mmap_reader(self):
+        with TempFile() as temp:
+            temp.write_bytes(b"one\ntwo\n\nthree")
+            reader = MmapReader(temp.os_path)
+            self.assertTrue(reader.seekable())
+            self.assertEqual(reader.read(3), b"one")
+            reader.seek(-5, 2)
+            self.assertEqual(reader.read(), b"three")
+            reader.seek(0)
+            self.assertEqual(list(reader.chunks(5)), [b"one\nt", b"wo\n\nt", b"hree"])
+            reader.seek(0)
+            reader.chunk_size = 2  # LINES LONGER THAN A BLOCK
+            self.assertEqual(list(reader.lines(encoding=None)), [b"one", b"two", b"", b"three"])
+            reader.close()
+            self.assertEqual(temp.bytes().lines().to_list(), ["one", "two", "", "three"])
+            # PUBLIC chunk_bytes() RETURNS bytes, EVEN FOR A MAPPED FILE
+            chunks = list(chunk_bytes(temp.bytes()))
+            self.assertEqual([type(c) for c in chunks], [bytes])
+            self.assertEqual(chunks[0].split(b"\n")[0], b"one")
+
+    def test_lines_across_chunks(self):
+        chunks = [b"ab\nc\xc3", b"\xa9", b"d\n\n", b"e"]
+        self.assertEqual(ByteStream(Reader(iter(chunks))).lines().to_list(), ["ab", "c\u00e9d", "", "e"])
+        self.assertEqual(
+            ByteStream(Reader(iter(chunks))).lines(encoding=None).to_list(), [b"ab", b"c\xc3\xa9d", b"", b"e"]
+        )
+        text = StringStream(iter(["ab\nc", "d", "\n\n", "e\n"])).lines().to_list()
+        self.assertEqual(text, ["ab", "cd", "", "e"])
+
+    def test_decode_across_chunks(self):
+        data = "caf\u00e9 \u2603\n".encode("utf8") * 3
+        chunks = [data[i : i + 1] for i in range(len(data))]
+        self.assertEqual(ByteStream(Reader(iter(chunks))).utf8().to_str(), data.decode("utf8"))
+        self.assertEqual(ByteStream(Reader(iter([b"a\xffb"]))).utf8(errors="replace").to_str(), "a\ufffdb")
+        # chunk_size APPLIES TO ANY SOURCE
+        self.assertEqual(len(list(ByteStream(Reader(iter([b"x" * 100]))).utf8(chunk_size=10)._chunks)), 10)
+        with TempFile() as temp:
+            temp.write_bytes(b"x" * 100)
+            self.assertEqual(len(list(temp.bytes().utf8(chunk_size=10)._chunks)), 10)
+        text = "one\ntwo\n".encode("utf16")
+        self.assertEqual(ByteStream(Reader(iter([text]))).lines(encoding="utf16").to_list(), ["one", "two"])
+
+    def test_jsonl(self):
+        data = ByteStream(Reader(iter([b'{"a": 1}\n\n{"a": 2, ', b'"b": "x"}\nnot json\n'])))
+        result = data.jsonl()
+        self.assertEqual(result.typer.type_, JxType(a=JX_INTEGER, b=JX_TEXT))
+        self.assertEqual(result.map(it.a).to_list(), [1, 2, None])
+        broken = ByteStream(Reader(iter([b'{"a":1\n"b":2}\n5,6\n7\n']))).jsonl().to_list()
+        self.assertEqual(broken, [None, None, None, 7])
+
+        # NOTHING IS READ UNTIL THE STREAM (OR ITS TYPE) IS NEEDED, AND THE SOURCE IS CLOSED ON EARLY EXIT
+        read, closed = [], []
+
+        def chunks():
+            try:
+                for i in range(1000):
+                    read.append(i)
+                    yield b'{"a": %d}\n' % i
+            finally:
+                closed.append(True)
+
+        source = chunks()
+        values = ByteStream(Reader(source)).jsonl()
+        self.assertEqual(read, [])
+        self.assertEqual(values.first().a, 0)
+        self.assertEqual(closed, [True])
+
+    def test_json_query_path(self):
+        data = ByteStream(Reader(iter([b'{"meta": {"x": 1}, "a": {"b": [{"c": 1}, ', b'{"c": 2}]}}'])))
+        self.assertEqual(data.json("a.b").map(it.c).to_list(), [1, 2])
+
+    def test_to_jsonl(self):
+        data = [{"a": 1, "b": "\u2603"}, {"a": float("nan")}, Data(c=[1, 2])]
+        result = stream(data).to_jsonl(batch_size=2).to_bytes()
+        self.assertEqual(result, '{"a":1,"b":"\u2603"}\n{}\n{"c":[1,2]}\n'.encode("utf8"))
+        # null PROPERTIES ARE DROPPED BY BOTH ENCODERS
+        mixed = stream([{"a": None, "b": 1}, {"a": None, "b": float("nan")}, ({"c": None},)]).to_jsonl().to_bytes()
+        self.assertEqual(mixed, b'{"b":1}\n{}\n[{}]\n')
+        round_trip = stream(data).to_jsonl().to_zst().from_zst().jsonl().map(it.a).to_list()
+        self.assertEqual(round_trip, [1, None, None])
+
+    def test_csv_types(self):
+        content = [
+            'id,name,score,ok,when\n1,"Alice, A",1.5,true,2020-01-01\n2,"B',
+            'ob\nB",,FALSE,2020-01-02T03:04:05\n',
+        ]
+        result = StringStream(iter(content)).csv(infer_types=True)
+        self.assertEqual(result.typer.type_, JxType(id=int, name=str, score=float, ok=bool, when=datetime))
+        self.assertEqual(
+            result.to_list(),
+            [
+                {"id": 1, "name": "Alice, A", "score": 1.5, "ok": True, "when": datetime(2020, 1, 1)},
+                {"id": 2, "name": "Bob\nB", "score": None, "ok": False, "when": datetime(2020, 1, 2, 3, 4, 5)},
+            ],
+        )
+        rows = ByteStream(Reader(iter([b"a;b\n1;x\n2;y\n"]))).csv(delimiter=";", infer_types=True, output="tuple")
+        self.assertEqual(rows.to_list(), [(1, "x"), (2, "y")])
+
+        # SHORT ROWS ARE FILLED, EXTRA CELLS ARE KEPT, LIKE csv.DictReader
+        ragged = "a,b,c\n1,2\n\n3,4,5,6\n"
+        expected = [{"a": "1", "b": "2", "c": None}, {"a": "3", "b": "4", "c": "5", None: ["6"]}]
+        self.assertEqual(StringStream(iter([ragged])).csv().to_list(), expected)
+        expected = [{"a": 1, "b": 2, "c": None}, {"a": 3, "b": 4, "c": 5, None: ["6"]}]
+        self.assertEqual(StringStream(iter([ragged])).csv(infer_types=True).to_list(), expected)
+
+        # A VALUE THAT DOES NOT FIT THE INFERRED TYPE IS KEPT AS str
+        late = "a\n1\n2\nx\n"
+        result = StringStream(iter([late])).csv(infer_types=True, sample_size=2, batch_size=2)
+        self.assertEqual(result.typer.type_, JxType(a=int))
+        self.assertEqual(result.to_list(), [{"a": 1}, {"a": 2}, {"a": "x"}])
+        self.assertEqual(result.typer.type_, JxType(a=str))
+        columns = StringStream(iter(["a,b\n1,x\n2,y\n"])).csv(output="columns", batch_size=1).to_list()
+        self.assertEqual(columns, [{"a": ["1"], "b": ["x"]}, {"a": ["2"], "b": ["y"]}])
+
+    def test_to_csv(self):
+        data = [{"a": 1, "b": "x, y"}, {"a": 2}, Data(a=3, b="z")]
+        self.assertEqual(stream(data).to_csv().to_bytes(), b'a,b\n1,"x, y"\n2,\n3,z\n')
+        content = StringStream(iter(["a,b\n1,x\n"])).csv(infer_types=True).to_csv().to_zst().from_zst().utf8().to_str()
+        self.assertEqual(content, "a,b\n1,x\n")
+        self.assertEqual(stream([(1, 2)]).to_csv(["x", "y"], delimiter="|").to_bytes(), b"x|y\n1|2\n")
+        nested = ByteStream(Reader(iter([b'{"a":{"b":1},"c":[1,2]}\n{"a":{"b":2},"c":3}\n']))).jsonl()
+        self.assertEqual(nested.to_csv().to_bytes(), b'a,c\n"{""b"":1}","[1,2]"\n"{""b"":2}",3\n')
+        self.assertEqual(stream([(1, {"x": 1})]).to_csv(["i", "j"]).to_bytes(), b'i,j\n1,"{""x"":1}"\n')
+
+    def test_zst_frames(self):
+        data = bytes(range(256)) * 1000
+        compressed = ByteStream(Reader(iter([data]))).to_zst(frame_size=10000, level=1).to_bytes()
+        skippable = (0x184D2A53).to_bytes(4, "little") + (3).to_bytes(4, "little") + b"abc"
+        compressed = skippable + compressed + ByteStream(Reader(iter([b"end"]))).to_zst(threads=2).to_bytes()
+        self.assertEqual(len(list(zst_frames(Reader(iter([compressed]))))), 27)
+        self.assertEqual(ByteStream(Reader(iter([compressed]))).from_zst().to_bytes(), data + b"end")
+        self.assertEqual(ByteStream(Reader(iter([compressed]))).from_zst(workers=3).to_bytes(), data + b"end")
+
+        # FROM THE FIRST FRAME TOO LARGE TO HOLD IN MEMORY, THE REST IS STREAMED
+        from mo_streams import byte_stream
+
+        noise = os.urandom(300_000)
+        big = ByteStream(Reader(iter([noise]))).to_zst(level=1).to_bytes()
+        read = []
+
+        def chunks():
+            for i in range(0, len(big), 100):
+                read.append(i)
+                yield big[i : i + 100]
+
+        max_frame_size, byte_stream.MAX_FRAME_SIZE = byte_stream.MAX_FRAME_SIZE, 5000
+        try:
+            mixed = ByteStream(Reader(iter([compressed + big + compressed]))).from_zst(workers=3).to_bytes()
+            self.assertEqual(mixed, data + b"end" + noise + data + b"end")
+            # A LARGE FRAME IS NOT READ WHOLE
+            self.assertEqual(ByteStream(Reader(chunks())).from_zst(workers=3).reader.read(10), noise[:10])
+            self.assertLess(len(read) * 100, len(big) / 2)
+        finally:
+            byte_stream.MAX_FRAME_SIZE = max_frame_size
+
+    def test_tar_index(self):
+        import io, tarfile
+
+        members = {f"dir/file{i}.txt": (f"content of {i}\n" * (i * 500)).encode("utf8") for i in range(8)}
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        plain = buffer.getvalue()
+        compressed = ByteStream(Reader(iter([plain]))).to_zst(frame_size=20000, level=1).to_bytes()
+
+        for data, ext in [(plain, "tar"), (compressed, "tar.zst")]:
+            with TempFile(f"delete_{randoms.base64(5)}.{ext}") as file, TempFile() as sidecar:
+                file.write_bytes(data)
+                file.bytes().to_tar_index().write(sidecar)
+                index = json2value(sidecar.read())
+                self.assertEqual(len(index.frames or []), 0 if ext == "tar" else 10)
+
+                wanted = ["dir/file6.txt", "dir/file3.txt"]
+                result = (
+                    file.bytes()
+                    .from_tar(index=sidecar, filter=wanted)
+                    .map(lambda f: (f.rel_path, f.content().to_bytes()))
+                    .to_list()
+                )
+                self.assertEqual(result, [(n, members[n]) for n in sorted(wanted)])
+                names = file.bytes().decompress().from_tar(filter=lambda n: n.endswith("7.txt")).rel_path.to_list()
+                self.assertEqual(names, ["dir/file7.txt"])
+
+    def test_async_streams(self):
+        import asyncio
+
+        data = "".join(f"line {i}\n" for i in range(1000)).encode("utf8")
+        compressed = ByteStream(Reader(iter([data]))).to_zst(frame_size=3000, level=1).to_bytes()
+
+        async def length(line):
+            await asyncio.sleep(0.001)
+            return len(line)
+
+        async def pipeline():
+            lines = ByteStream(Reader(iter([compressed]))).to_async().from_zst().lines()
+            result = await lines.filter(lambda l: l.endswith("7")).map(length, concurrency=50).to_list()
+            values = [v async for v in stream(range(5)).to_async().map(lambda v: v * 2)]
+            text = await StringStream(iter(["a\nb", "c\n"])).to_async().utf8().to_bytes()
+            # LIKE THE SYNC filter, A FAILED PREDICATE DROPS THE MEMBER
+            self.assertEqual(await stream([1, 0, 2]).to_async().filter(lambda v: 1 / v > 0).to_list(), [1, 2])
+            async with ByteStream(Reader(iter([data]))).to_async().lines() as lines:
+                self.assertEqual(await lines.limit(2).to_list(), ["line 0", "line 1"])
+
+            # EVERY STAGE CLOSES ITS UPSTREAM, DOWN TO THE SYNC SOURCE
+            closed = []
+
+            def source():
+                try:
+                    yield from range(1000)
+                finally:
+                    closed.append(True)
+
+            def chunks():
+                try:
+                    yield compressed
+                finally:
+                    closed.append(True)
+
+            # HOLD THE SOURCES, AND CHECK BEFORE THE NEXT await, SO THE GARBAGE COLLECTOR CAN NOT CLOSE THEM
+            values_source, chunks_source = source(), chunks()
+            odd = stream(values_source).to_async().map(lambda v: v + 1).filter(lambda v: v % 2)
+            self.assertEqual(await odd.first(), 1)
+            self.assertEqual(closed, [True])
+            first_line = await ByteStream(Reader(chunks_source)).to_async().from_zst().lines().first()
+            self.assertEqual(first_line, "line 0")
+            self.assertEqual(closed, [True, True])
+            return result, values, text
+
+        result, values, text = asyncio.run(pipeline())
+        self.assertEqual(result, [len(f"line {i}") for i in range(1000) if i % 10 == 7])
+        self.assertEqual(values, [0, 2, 4, 6, 8])
+        self.assertEqual(text, b"a\nbc\n")
+
+        # BACK TO SYNC
+        sync = ByteStream(Reader(iter([data]))).to_async().lines().limit(3).to_sync().to_list()
+        self.assertEqual(sync, ["line 0", "line 1", "line 2"])
+
+    def test_prefetch(self):
+        from threading import current_thread
+
+        threads = set()
+        closed = []
+
+        def source():
+            try:
+                for i in range(100):
+                    threads.add(current_thread().name)
+                    yield i
+            finally:
+                closed.append(True)
+
+        self.assertEqual(stream(source()).prefetch(5).map(lambda v: v + 1).to_list(), list(range(1, 101)))
+        self.assertIn("prefetch", threads)
+
+        # EARLY STOP CLOSES THE UPSTREAM
+        closed.clear()
+        self.assertEqual(stream(source()).prefetch(5).limit(3).to_list(), [0, 1, 2])
+        self.assertEqual(closed, [True])
+
+        def broken():
+            yield 1
+            raise ValueError("upstream problem")
+
+        with self.assertRaises(ValueError):
+            stream(broken()).prefetch(2).to_list()
+
+        data = bytes(range(256)) * 1000
+        compressed = ByteStream(Reader(iter([data]))).to_zst(level=1).to_bytes()
+        self.assertEqual(ByteStream(Reader(iter([compressed]))).from_zst().prefetch(4).to_bytes(), data)
+
+    def test_prefetch_archive_members(self):
+        import io, tarfile, zipfile
+
+        members = {f"file{i}.txt": f"content of {i}\n".encode("utf8") * 50 for i in range(200)}
+        tar, zip_ = io.BytesIO(), io.BytesIO()
+        with tarfile.open(fileobj=tar, mode="w") as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        with zipfile.ZipFile(zip_, mode="w") as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+
+        expected = [(n, d) for n, d in members.items()]
+        for data, ext in [(tar.getvalue(), "tar"), (zip_.getvalue(), "zip")]:
+            with TempFile(f"delete_{randoms.base64(5)}.{ext}") as file, TempFile() as sidecar:
+                file.write_bytes(data)
+                if ext == "zip":
+                    streams = [lambda: file.bytes().from_zip()]
+                else:
+                    file.bytes().to_tar_index().write(sidecar)
+                    streams = [lambda: file.bytes().from_tar(), lambda: file.bytes().from_tar(index=sidecar)]
+                for members_of in streams:
+                    # THE LISTING ENDS WHILE THE LAST MEMBERS ARE STILL QUEUED
+                    result = members_of().prefetch(8).map(lambda f: (f.rel_path, f.content().to_bytes())).to_list()
+                    self.assertEqual(result, expected)
+
+    def test_first_archive_member(self):
+        import io, tarfile, zipfile
+
+        tar, zip_ = io.BytesIO(), io.BytesIO()
+        with tarfile.open(fileobj=tar, mode="w") as archive:
+            for name, data in [("a.txt", b"first"), ("b.txt", b"last")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        with zipfile.ZipFile(zip_, mode="w") as archive:
+            archive.writestr("a.txt", b"first")
+            archive.writestr("b.txt", b"last")
+
+        for data, ext in [(tar.getvalue(), "tar"), (zip_.getvalue(), "zip")]:
+            with TempFile(f"delete_{randoms.base64(5)}.{ext}") as file:
+                file.write_bytes(data)
+                members_of = lambda: getattr(file.bytes(), f"from_{ext}")()
+                before = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+                # THE LISTING IS CLOSED, BUT THE MEMBER CAN STILL BE READ
+                self.assertEqual(members_of().first().content().to_bytes(), b"first")
+                self.assertEqual(members_of().last().content().to_bytes(), b"last")
+                self.assertEqual(members_of().limit(1).to_list()[0].content().to_bytes(), b"first")
+                after = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+                self.assertEqual(after, before)
+
+    def test_close_propagates(self):
+        closed = []
+
+        def source():
+            try:
+                yield from range(100)
+            finally:
+                closed.append(True)
+
+        self.assertEqual(stream(source()).map(lambda v: v * 2).first(), 0)
+        self.assertEqual(closed, [True])
+
+        closed.clear()
+        with stream(source()).filter(lambda v: v % 2) as s:
+            self.assertEqual(s.limit(2).to_list(), [1, 3])
+        self.assertEqual(closed, [True])
+
+        # THE CALLER'S GENERATOR IS THE SOURCE OF THE CHAIN, EVEN WHILE THE CALLER HOLDS IT
+        closed.clear()
+        held = source()
+        self.assertEqual(stream(held).limit(2).to_list(), [0, 1])
+        self.assertEqual(closed, [True])
+
+        closed.clear()
+        held = source()
+        self.assertEqual(stream(held).batched(4).limit(1).to_list(), [0])
+        self.assertEqual(closed, [True])
+
+        closed.clear()
+        held = source()
+        with stream(held).batched(4) as batches:
+            self.assertEqual(next(batches._batches)[0], [0, 1, 2, 3])
+        self.assertEqual(closed, [True])
+
+        def chunks():
+            try:
+                yield ByteStream(Reader(iter([b"some text\n" * 100]))).to_gzip().to_bytes()
+            finally:
+                closed.append(True)
+
+        closed.clear()
+        with ByteStream(Reader(chunks())).from_gzip() as s:
+            self.assertEqual(s.reader.read(4), b"some")
+        self.assertEqual(closed, [True])
+
+        # NO FILE DESCRIPTORS LEAK WHEN ONLY PART OF A FILE IS READ
+        with TempFile() as temp:
+            temp.write_bytes(b"line\n" * 1000)
+            before = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+            for _ in range(50):
+                self.assertEqual(temp.bytes().lines().first(), "line")
+            after = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+            self.assertEqual(after, before)
+
+        # THE FILE UNDER A DECOMPRESSED STREAM IS CLOSED TOO
+        with TemporaryDirectory() as temp:
+            file = File(temp) / "data.txt.gz"
+            file.write_bytes(ByteStream(Reader(iter([b"line\n" * 1000]))).to_gzip().to_bytes())
+            before = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+            # KEEP REFERENCES, SO NOTHING IS CLOSED BY THE GARBAGE COLLECTOR
+            contents = [file.content() for _ in range(10)]
+            for content in contents:
+                self.assertEqual(content.reader.read(4), b"line")
+                content.close()
+            after = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+            self.assertEqual(after, before)
+
+    def test_zst_dictionary(self):
+        dictionary = b'{"name": "value", "other": "thing"}' * 10
+        record = b'{"name": "value", "other": "thing", "id": 1}'
+        compressed = ByteStream(Reader(iter([record]))).to_zst(dictionary=dictionary).to_bytes()
+        result = ByteStream(Reader(iter([compressed]))).from_zst(dictionary=dictionary).to_bytes()
+        self.assertEqual(result, record)
+
+    def test_gzip_bz2_xz(self):
+        import bz2, lzma
+
+        data = b"some text\n" * 1000
+        for compressed, ext in [
+            (ByteStream(Reader(iter([data]))).to_gzip().to_bytes(), "gz"),
+            (bz2.compress(data), "bz2"),
+            (lzma.compress(data), "xz"),
+        ]:
+            with TempFile(ext) as temp:
+                temp.write_bytes(compressed)
+                self.assertEqual(temp.content().to_bytes(), data)
+            # BY MAGIC BYTES
+            self.assertEqual(ByteStream(Reader(iter([compressed]))).decompress().to_bytes(), data)
+        self.assertEqual(ByteStream(Reader(iter([data]))).decompress().to_bytes(), data)
+
+    def test_writer_high_water(self):
+        writer = Writer(high_water=10)
+        writer.write(b"12345678")
+        producer = Thread(target=lambda: writer.write(b"abcdef"))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(writer.read(4), b"1234")
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(b"".join(writer.drain()), b"5678abcdef")
+
     def test_dict_zip(self):
         values = ["a", "b", "c"]
         result = stream(values).enumerate().to_dict()
@@ -111,14 +588,55 @@ class TestStream(TestCase):
         result = stream([2, 3, 1]).sort().to_list()
         self.assertEqual(result, [1, 2, 3])
 
+    def test_sort_key(self):
+        result = stream([{"a": 2}, {"a": 3}, {"a": 1}]).enumerate().sort(key=it["a"]).to_list()
+        self.assertEqual(result, [{"a": 1}, {"a": 2}, {"a": 3}])
+
+    def test_sort_spill(self):
+        values = [(i * 7919) % 1000 for i in range(1000)]
+        result = (
+            stream(values).enumerate().sort(key=lambda v: v // 10, memory_limit=64).map(lambda v: v // 10).to_list()
+        )
+        self.assertEqual(result, sorted(v // 10 for v in values))
+        # STABLE
+        tens = stream(values).sort(key=lambda v: v // 10, reverse=True, memory_limit=64).to_list()
+        self.assertEqual(tens, sorted(values, key=lambda v: v // 10, reverse=True))
+
+    def test_top_k(self):
+        result = stream([5, 1, 4, 2, 3]).top_k(2)
+        self.assertEqual(result.to_list(), [5, 4])
+        result = stream([5, 1, 4, 2, 3]).sort().limit(3)
+        self.assertEqual(result.to_list(), [1, 2, 3])
+
     def test_reverse(self):
         result = stream([2, 3, 1]).reverse().to_list()
         self.assertEqual(result, [1, 3, 2])
 
+    def test_reverse_spill(self):
+        result = stream(range(100)).reverse(memory_limit=7).to_list()
+        self.assertEqual(result, list(reversed(range(100))))
+
     def test_distinct(self):
         result = stream([2, 2, 2, 1, 4, 3, 1]).distinct().to_list()
         self.assertEqual(result, [2, 1, 4, 3])
 
+    def test_distinct_spill(self):
+        values = [(i * 7919) % 500 for i in range(2000)]
+        result = stream(values).distinct(mode="spill", memory_limit=50).to_list()
+        self.assertEqual(len(result), 500)
+        self.assertEqual(set(result), set(values))
+        self.assertEqual(result[:50], list(dict.fromkeys(values))[:50])
+
+        # FAR MORE VALUES THAN FIT IN THE FIRST PARTITIONS, SO THEY ARE PARTITIONED AGAIN
+        result = stream(values).distinct(mode="spill", memory_limit=3).to_list()
+        self.assertEqual(sorted(result), list(range(500)))
+
+    def test_distinct_bloom(self):
+        values = [str(i % 1000) for i in range(3000)]
+        result = stream(values).distinct(mode="bloom", memory_limit=1000, error_rate=0.01).to_list()
+        self.assertEqual(len(set(result)), len(result))
+        self.assertGreater(len(result), 950)
+
     def test_limit_under(self):
         result = stream(range(200)).limit(10).to_list()
         self.assertEqual(result, list(range(10)))
@@ -198,6 +716,22 @@ class TestStream(TestCase):
         result = stream(["1", "2", "3"]).map(length).to_list()
         self.assertEqual(result, [1, 1, 1])
 
+    def test_map_threads(self):
+        result = stream(range(100)).map(lambda v: v * 2, workers=4).to_list()
+        self.assertEqual(result, [v * 2 for v in range(100)])
+
+    def test_map_threads_unordered(self):
+        result = stream(range(100)).map(lambda v: v * 2, workers=4, ordered=False).to_list()
+        self.assertEqual(sorted(result), [v * 2 for v in range(100)])
+
+    def test_map_threads_error(self):
+        result = stream([1, 0, 2]).map(lambda v: 2 // v, workers=2).to_list()
+        self.assertEqual(result, [2, None, 1])
+
+    def test_map_processes(self):
+        result = stream(["a", "bb", "ccc"]).map(length, workers=2, executor="process").to_list()
+        self.assertEqual(result, [1, 2, 3])
+
     def test_map_lambda(self):
         result = stream(["1", "2", "3"]).map(lambda v: int(v) + 1).to_list()
         self.assertEqual(result, [2, 3, 4])
@@ -225,6 +759,60 @@ class TestStream(TestCase):
         )
         self.assertEqual(result, [{"group": 0, "value": 2}, {"group": 1, "value": 4}])
 
+    def test_batched(self):
+        result = stream([1, 2, 3, 4, 5]).batched(2).filter(it > 2).map(it / 2).to_list()
+        self.assertEqual(result, [1.5, 2.0, 2.5])
+
+    def test_batched_attachments(self):
+        result = (
+            stream(["a", "b", "c"])
+            .batched(2)
+            .enumerate()
+            .attach(upper=it.upper())
+            .map(lambda v, att: f"{att['index']}{att['upper']}")
+            .to_list()
+        )
+        self.assertEqual(result, ["0A", "1B", "2C"])
+
+    def test_batched_error(self):
+        result = stream(["1", "x", "3"]).batched().map(int).unbatch().to_list()
+        self.assertEqual(result, [1, None, 3])
+
+    def test_batched_calls_once(self):
+        calls = []
+
+        def half(v):
+            calls.append(v)
+            return 10 // (v - 2)
+
+        result = stream(list(range(5))).batched(10).map(half).attach(x=it.bit_length()).to_list()
+        self.assertEqual(result, [-5, -10, None, 10, 5])
+        self.assertEqual(calls, [0, 1, 2, 3, 4])
+
+    def test_batched_numeric(self):
+        result = stream([4, 0, 2 ** 62]).batched().map(it + it).attach(double=it).map(it / it.double).to_list()
+        self.assertEqual(result, [1.0, None, 1.0])
+
+    def test_batched_exact(self):
+        mixed = stream([1, 2.5, 3]).batched(10)
+        self.assertEqual([type(v) for v in mixed.filter(it > 0).to_list()], [int, float, int])
+        mixed = stream([1, 2.5, 3]).batched(10).map(1 + it).to_list()
+        self.assertEqual([type(v) for v in mixed], [int, float, int])
+        self.assertEqual(stream([True, 2, 3]).batched(10).filter(it > 0).to_list(), [True, 2, 3])
+        self.assertIs(stream([True, 2, 3]).batched(10).filter(it > 0).first(), True)
+        big = 2 ** 60 + 1
+        self.assertEqual(stream([big, 1.5]).batched(10).filter(it > 1).to_list(), [big, 1.5])
+        self.assertEqual(stream([big, 3]).batched(10).filter(it > big - 1.0).to_list(), [big])
+
+    def test_batched_sum(self):
+        result = stream(range(10000)).batched(1000).filter(it >= 5000).map(it / 2).sum()
+        self.assertEqual(result, sum(v / 2 for v in range(5000, 10000)))
+
+    def test_compiled_expression(self):
+        built = compiled(normalize((3 + it) > 5).build(Typer(python_type=int), JxType()))
+        self.assertEqual(built.function.source, "((c0 + v) > c1)")
+        self.assertEqual(stream([1, 2, 3, 4]).filter((3 + it) > 5).to_list(), [3, 4])
+
     def test_first(self):
         result = stream([1, 2, 3]).first()
         self.assertEqual(result, 1)
@@ -338,6 +926,59 @@ class TestStream(TestCase):
 
         self.assertEqual(result, [{"id": "1", "name": "Alice"}, {"id": "2", "name": "Bob"}])
 
+    @mock_aws
+    def test_s3_multipart(self):
+        s3 = boto3.resource("s3")
+        bucket_name = "bucket-" + randoms.hex(10)
+        s3.create_bucket(Bucket=bucket_name)
+
+        data = bytes(range(256)) * (45 * 1024)  # 11.25MB, THREE 5MB PARTS
+        stream(data).to_s3(name="big", bucket=bucket_name, part_size=5 * 1024 * 1024, workers=3)
+        self.assertEqual(from_s3(bucket_name, "big").content(workers=1).to_bytes(), data)
+        self.assertEqual(from_s3(bucket_name, "big").content(part_size=1000000, workers=4, prefetch=2).to_bytes(), data)
+
+        files = [File_usingStream(f"file{i}", lambda i=i: stream(b"x" * i)) for i in range(5)]
+        keys = stream(files).to_s3(bucket=bucket_name, prefix="many/", workers=3)
+        self.assertEqual(keys, [f"many/file{i}" for i in range(5)])
+        self.assertEqual(from_s3(bucket_name, "many/file3").content().to_bytes(), b"xxx")
+        self.assertEqual(from_s3(bucket_name, "many/file0").content().to_bytes(), b"")
+        # THE OLD FORM, WITH A boto3 Object
+        self.assertEqual(S3Object(s3.Object(bucket_name, "many/file3")).content().to_bytes(), b"xxx")
+
+        # A SMALL OBJECT IS ONE GET
+        client = boto3.client("s3")
+        calls = []
+        client.meta.events.register("before-call.s3", lambda model, **kwargs: calls.append(model.name))
+        self.assertEqual(from_s3(bucket_name, "many/file4", client=client).content().to_bytes(), b"xxxx")
+        self.assertEqual(calls, ["GetObject"])
+
+        with self.assertRaises(Exception):
+            stream(b"data").to_s3(name="test", bucket="bucket-does-not-exist")
+
+    @mock_aws
+    def test_s3_prefix(self):
+        s3 = boto3.resource("s3")
+        bucket_name = "bucket-" + randoms.hex(10)
+        bucket = s3.create_bucket(Bucket=bucket_name)
+        for i in range(30):
+            bucket.put_object(Key=f"day/{i:03}.json", Body=f'{{"i": {i}}}')
+        bucket.put_object(Key="other/000.json", Body="{}")
+
+        # SMALLER OBJECTS ARE PREFETCHED, LARGER ARE DOWNLOADED WHEN REQUESTED
+        files = from_s3_prefix(bucket_name, "day/", prefetch=4, prefetch_size=8)
+        result = files.map(lambda f: json2value(f.content().utf8().to_str()).i).to_list()
+        self.assertEqual(result, list(range(30)))
+
+        wanted = ["day/003.json", "day/017.json"]
+        result = (
+            from_s3_prefix(bucket_name, "day/", filter=wanted, prefetch=0)
+            .map(lambda f: f.content().to_bytes())
+            .to_list()
+        )
+        self.assertEqual(result, [b'{"i": 3}', b'{"i": 17}'])
+        keys = from_s3_prefix(bucket_name, filter=lambda k: k.startswith("other")).map(lambda f: f.rel_path).to_list()
+        self.assertEqual(keys, ["other/000.json"])
+
     def test_from_csv_w_map(self):
         result = (
             stream("id,name\n1,Alice\n2,Bob")
@@ -388,6 +1029,37 @@ class TestStream(TestCase):
 
         self.assertEqual(counts, {"apple": 3, "pear": 2, "orange": 1})
 
+    def test_aggregate(self):
+        values = ["apple", "pear", "apple", "orange", "pear", "apple"]
+        result = stream(values).aggregate(it, name="fruit", count=Count(), length=Max(len)).to_list()
+        self.assertEqual(
+            result,
+            [
+                {"fruit": "apple", "count": 3, "length": 5},
+                {"fruit": "pear", "count": 2, "length": 4},
+                {"fruit": "orange", "count": 1, "length": 6},
+            ],
+        )
+
+    def test_aggregate_whole_stream(self):
+        result = stream([1, 2, 3, None]).aggregate(
+            count=Count(), total=Sum(), mean=Mean(), first=First(), product=Reduce(lambda x, y: x * y)
+        ).first()
+        self.assertEqual(result, {"group": None, "count": 4, "total": 6, "mean": 2, "first": 1, "product": 6})
+
+    def test_aggregate_spill(self):
+        result = (
+            stream(range(1000))
+            .aggregate(it % 100, memory_limit=10, count=Count(), low=Min(), high=Max(), first=First())
+            .to_dict(key="group")
+        )
+        self.assertEqual(len(result), 100)
+        self.assertEqual(result[7], {"group": 7, "count": 10, "low": 7, "high": 907, "first": 7})
+
+        result = stream(range(5000)).aggregate(it % 1000, memory_limit=3, count=Count(), high=Max()).to_list()
+        self.assertEqual(len(result), 1000)
+        self.assertTrue(all(r["count"] == 5 and r["high"] == r["group"] + 4000 for r in result))
+
     def test_use_a_function(self):
         def add_1(values, att) -> int:
             return sum(v['a'] for v in values.to_list())